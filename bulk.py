@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+
+"""bulk.py
+
+Conference Central streaming bulk import & export of conferences and
+sessions; used by the /admin/import, /admin/export and /tasks/import_chunk
+handlers in main.py
+
+"""
+
+import csv
+import itertools
+import json
+import logging
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import Conference
+from models import Session
+from models import SessionType
+from models import ImportJob
+from models import ImportChunk
+
+from conference import ConferenceApi
+from conference import DEFAULTS
+from conference import SESSION_DEFAULTS
+from repository import repo
+
+IMPORT_CHUNK_SIZE = 50          # max records per import task
+IMPORT_CHUNK_BYTES = 90000      # serialized records per ImportChunk entity
+EXPORT_PAGE_SIZE = 20           # conferences per datastore page
+EXPORT_MAX_PAGES = 10           # pages written per export response
+ROSTER_PAGE_SIZE = 500          # registrations per keys-only page
+ROSTER_GET_BATCH = 100          # profiles per get_multi
+ROSTER_MAX_PAGES = 10           # pages written per roster response
+
+CSV_COLUMNS = ['kind', 'websafeKey', 'websafeConferenceKey',
+               'name', 'description', 'topics', 'city', 'startDate',
+               'endDate', 'maxAttendees', 'seatsAvailable',
+               'sessionName', 'highlights', 'speaker', 'typeOfSession',
+               'sessionDate', 'startTime', 'duration']
+
+ROSTER_COLUMNS = ['userId', 'displayName', 'mainEmail', 'teeShirtSize']
+
+# - - - Reading - - - - - - - - - - - - - - - - - - - - - - -
+
+def readRecords(fileobj, fmt='jsonl'):
+    """Yield import records from a JSONL or CSV stream, one at a time.
+
+    A record is either {'conference': {...}, 'sessions': [...]} for a new
+    conference, or {'websafeConferenceKey': ..., 'sessions': [...]} for
+    sessions added to an existing conference.
+    """
+    if fmt == 'csv':
+        return _readCsvRecords(fileobj)
+    return _readJsonlRecords(fileobj)
+
+
+def _readJsonlRecords(fileobj):
+    """One conference (with optional 'sessions' list) or session per line."""
+    for line in fileobj:
+        line = line.strip()
+        if not line:
+            continue
+        row = json.loads(line)
+        wsck = row.pop('websafeConferenceKey', None)
+        if wsck:
+            yield {'websafeConferenceKey': wsck, 'sessions': [row]}
+        else:
+            sessions = row.pop('sessions', None) or []
+            yield {'conference': row, 'sessions': sessions}
+
+
+def _readCsvRecords(fileobj):
+    """Rows with a 'kind' column; session rows without a
+    websafeConferenceKey belong to the conference row before them.
+    """
+    record = None
+    for row in csv.DictReader(fileobj):
+        kind = (row.pop('kind', None) or '').strip().lower()
+        row = dict((k, v.decode('utf-8')) for k, v in row.items()
+                   if k and v not in (None, ''))
+        if kind == 'conference':
+            if record:
+                yield record
+            if 'topics' in row:
+                row['topics'] = row['topics'].split('|')
+            record = {'conference': row, 'sessions': []}
+        elif kind == 'session':
+            wsck = row.pop('websafeConferenceKey', None)
+            if wsck:
+                yield {'websafeConferenceKey': wsck, 'sessions': [row]}
+            elif record:
+                record['sessions'].append(row)
+            else:
+                raise ValueError('Session row before any conference row')
+        else:
+            raise ValueError('Unknown record kind: %s' % kind)
+    if record:
+        yield record
+
+
+def chunkRecords(records, size=IMPORT_CHUNK_SIZE, max_bytes=IMPORT_CHUNK_BYTES):
+    """Group records into lists bounded by count and serialized size."""
+    chunk = []
+    nbytes = 0
+    for record in records:
+        rbytes = len(json.dumps(record))
+        if chunk and (len(chunk) >= size or nbytes + rbytes > max_bytes):
+            yield chunk
+            chunk = []
+            nbytes = 0
+        chunk.append(record)
+        nbytes += rbytes
+    if chunk:
+        yield chunk
+
+# - - - Import - - - - - - - - - - - - - - - - - - - - - - - -
+
+def enqueueImport(job_id, organizer_user_id, fileobj, fmt='jsonl'):
+    """Stream fileobj into import tasks, checkpointing after every chunk.
+
+    Each chunk is stored in an ImportChunk and its task carries only the
+    chunk index, as URL-encoded records can outgrow the task size limit.
+    Re-running with the same job_id resumes after the last enqueued chunk.
+    """
+    job = repo.getOrInsert(ImportJob, job_id,
+        organizerUserId=organizer_user_id, format=fmt)
+    records = itertools.islice(readRecords(fileobj, job.format),
+                               job.recordsEnqueued, None)
+    for chunk in chunkRecords(records):
+        _addImportTask(job_id, job.chunksEnqueued, chunk)
+        job.chunksEnqueued += 1
+        job.recordsEnqueued += len(chunk)
+        repo.put(job)
+    return job
+
+
+def _addImportTask(job_id, index, chunk):
+    """Store one chunk & enqueue its task; a chunk already stored is kept
+    as it is, and the task name makes re-enqueues harmless.
+    """
+    repo.getOrInsert(ImportChunk, '%s-%d' % (job_id, index),
+                     jobId=job_id, records=chunk)
+    try:
+        taskqueue.add(
+            name='import-%s-%d' % (job_id, index),
+            params={
+                'jobId': job_id,
+                'chunk': index,
+                },
+            url='/tasks/import_chunk'
+            )
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def importChunk(job_id, index):
+    """Write one stored chunk of records with allocate_ids and put_multi.
+
+    Allocated keys are saved before the write so a retried task
+    overwrites the same entities instead of duplicating them. Records
+    adding sessions to a conference that is malformed, missing or not
+    the organizer's are rejected, and saved as such, before allocating.
+    """
+    job = repo.get(ndb.Key(ImportJob, job_id))
+    if not job:
+        logging.error('importChunk :: unknown import job %s', job_id)
+        return
+    c_key = ndb.Key(ImportChunk, '%s-%d' % (job_id, index))
+    marker = repo.get(c_key)
+    if not marker:
+        logging.error('importChunk :: unknown import chunk %s', c_key.id())
+        return
+    if marker.done:
+        return
+    records = marker.records
+    if not marker.allocated:
+        marker.rejected = _rejectedRecords(records, job.organizerUserId)
+        for i in marker.rejected:
+            logging.warning('importChunk :: rejecting record %d in %s: no conference %s of %s',
+                            i, c_key.id(), records[i]['websafeConferenceKey'], job.organizerUserId)
+        p_key = ndb.Key(Profile, job.organizerUserId)
+        marker.failed = len(marker.rejected)
+        marker.keys = _allocateKeys(p_key, _accepted(records, marker.rejected))
+        marker.allocated = True
+        repo.put(marker)
+    records = _accepted(records, marker.rejected)
+
+    entities = []
+    keys = iter(marker.keys)
+    for record in records:
+        try:
+            entities.extend(_recordToEntities(record, keys, job.organizerUserId))
+        except (ValueError, KeyError, TypeError, AttributeError), e:
+            logging.warning('importChunk :: skipping record in %s: %s', c_key.id(), e)
+            marker.failed += 1
+    _copyConferenceFields(entities)
+    repo.putMulti(entities)
+    # recounts are idempotent, so queue them before marking the chunk
+    # done, in case the task dies in between
+    for speaker in set(e.speaker for e in entities if isinstance(e, Session)):
+        ConferenceApi._queueSpeakerRecount(speaker)
+    marker.done = True
+    marker.records = None
+    repo.put(marker)
+
+    if any(isinstance(entity, Conference) for entity in entities):
+        ConferenceApi._invalidateConferenceQueries()
+
+    # existing conferences that gained sessions need their indexes
+    # rebuilt, and every conference touched needs its dashboard recounted
+    for record, conf_key in zip(records, _recordParents(records, marker.keys)):
+        wsck = conf_key.urlsafe()
+        if 'websafeConferenceKey' in record:
+            ConferenceApi._invalidateSessionIndex(wsck)
+        ConferenceApi._queueDashboardRebuild(wsck)
+
+
+def _copyConferenceFields(entities):
+    """Copy their conference's search fields onto the sessions among
+    entities; their conference is in entities, or already stored.
+    """
+    confs = dict((e.key, e) for e in entities if isinstance(e, Conference))
+    stored = list(set(e.key.parent() for e in entities
+                      if isinstance(e, Session)) - set(confs))
+    confs.update((key, conf) for key, conf in zip(stored, repo.getMulti(stored)) if conf)
+    for entity in entities:
+        if isinstance(entity, Session) and entity.key.parent() in confs:
+            ConferenceApi._copyConferenceFields(confs[entity.key.parent()], entity)
+
+
+def _rejectedRecords(records, organizer_user_id):
+    """Indexes of the records adding sessions to a conference key that is
+    malformed, or not of an existing conference of the organizer.
+    """
+    rejected = []
+    parents = {}
+    for i, record in enumerate(records):
+        if 'conference' in record:
+            continue
+        try:
+            key = ndb.Key(urlsafe=str(record['websafeConferenceKey']))
+        except Exception:
+            key = None
+        if key is None or key.kind() != Conference.__name__ or key.parent() is None \
+                or key.parent() != ndb.Key(Profile, organizer_user_id):
+            rejected.append(i)
+        else:
+            parents[i] = key
+    keys = list(set(parents.values()))
+    found = set(conf.key for conf in repo.getMulti(keys) if conf)
+    rejected.extend(i for i, key in parents.items() if key not in found)
+    return sorted(rejected)
+
+
+def _accepted(records, rejected):
+    """records without the rejected indexes."""
+    rejected = set(rejected)
+    return [record for i, record in enumerate(records) if i not in rejected]
+
+
+def _recordParents(records, keys):
+    """Conference key of each record, given the chunk's allocated keys."""
+    keys = iter(keys)
+    parents = []
+    for record in records:
+        if 'conference' in record:
+            parents.append(next(keys))
+        else:
+            parents.append(ndb.Key(urlsafe=str(record['websafeConferenceKey'])))
+        for _ in record['sessions']:
+            next(keys)
+    return parents
+
+
+def _allocateKeys(p_key, records):
+    """Return the keys for all entities in records, in record order."""
+    n_confs = len([r for r in records if 'conference' in r])
+    next_id = 0
+    if n_confs:
+        next_id = repo.allocateIds(Conference, n_confs, parent=p_key)
+
+    # one id range per parent conference, allocated in parallel
+    parents = []
+    for record in records:
+        if 'conference' in record:
+            parents.append(ndb.Key(Conference, next_id, parent=p_key))
+            next_id += 1
+        else:
+            parents.append(ndb.Key(urlsafe=str(record['websafeConferenceKey'])))
+    futures = [repo.allocateIdsAsync(Session, len(r['sessions']), parent=parent)
+               if r['sessions'] else None
+               for r, parent in zip(records, parents)]
+
+    keys = []
+    for record, parent, future in zip(records, parents, futures):
+        if 'conference' in record:
+            keys.append(parent)
+        if future:
+            first = future.get_result()
+            keys.extend(ndb.Key(Session, first + i, parent=parent)
+                        for i in range(len(record['sessions'])))
+    return keys
+
+
+def _recordToEntities(record, keys, organizer_user_id):
+    """Build the Conference/Session entities for one record."""
+    # take this record's keys up front so a bad record can't shift them
+    conf_key = next(keys) if 'conference' in record else None
+    sess_keys = [next(keys) for _ in record['sessions']]
+
+    entities = []
+    if conf_key:
+        entities.append(_conferenceFromDict(record['conference'], conf_key,
+                                            organizer_user_id))
+    for data, key in zip(record['sessions'], sess_keys):
+        entities.append(_sessionFromDict(data, key))
+    return entities
+
+
+def _conferenceFromDict(data, key, organizer_user_id):
+    """Convert an imported conference dict into a Conference entity."""
+    if not data.get('name'):
+        raise ValueError("Conference 'name' field required")
+    conf = Conference(key=key, name=data['name'],
+                      description=data.get('description'),
+                      organizerUserId=organizer_user_id)
+    conf.topics = data.get('topics') or DEFAULTS['topics']
+    conf.city = data.get('city') or DEFAULTS['city']
+    conf.maxAttendees = int(data.get('maxAttendees') or DEFAULTS['maxAttendees'])
+    conf.seatsAvailable = conf.maxAttendees
+    conf.month = 0
+    if data.get('startDate'):
+        conf.startDate = datetime.strptime(data['startDate'][:10], '%Y-%m-%d').date()
+        conf.month = conf.startDate.month
+    if data.get('endDate'):
+        conf.endDate = datetime.strptime(data['endDate'][:10], '%Y-%m-%d').date()
+    return conf
+
+
+def _sessionFromDict(data, key):
+    """Convert an imported session dict into a Session entity."""
+    typeOfSession = str(data.get('typeOfSession') or 'NOT_SPECIFIED')
+    SessionType(typeOfSession)      # raises TypeError if not a SessionType
+    return Session(
+        key=key,
+        sessionName=data['sessionName'],
+        highlights=data.get('highlights') or '',
+        speaker=data['speaker'],
+        typeOfSession=typeOfSession,
+        sessionDate=datetime.strptime(data['sessionDate'][:10], '%Y-%m-%d').date(),
+        startTime=datetime.strptime(str(data['startTime']).zfill(4)[:4], '%H%M').time(),
+        duration=int(data.get('duration') or SESSION_DEFAULTS['duration']),
+        )
+
+# - - - Export - - - - - - - - - - - - - - - - - - - - - - - -
+
+def exportConferences(out, cursor=None, fmt='jsonl', max_pages=EXPORT_MAX_PAGES):
+    """Write conferences and their sessions to out, a page at a time.
+
+    Returns the urlsafe cursor to continue from, or None when done.
+    """
+    start = cursor or None
+    writer = None
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, CSV_COLUMNS)
+        if not cursor:
+            writer.writerow(dict(zip(CSV_COLUMNS, CSV_COLUMNS)))
+
+    for _ in range(max_pages):
+        confs, start = repo.query(Conference).fetchPage(EXPORT_PAGE_SIZE, start)
+        futures = [repo.query(Session, ancestor=conf.key).fetchAsync() for conf in confs]
+        for conf, future in zip(confs, futures):
+            sessions = future.get_result()
+            if writer:
+                _writeCsv(writer, conf, sessions)
+            else:
+                row = _conferenceToDict(conf)
+                row['sessions'] = [_sessionToDict(sess) for sess in sessions]
+                out.write(json.dumps(row) + '\n')
+        if not start:
+            return None
+    return start
+
+
+def _conferenceToDict(conf):
+    return {
+        'websafeKey': conf.key.urlsafe(),
+        'name': conf.name,
+        'description': conf.description,
+        'topics': conf.topics,
+        'city': conf.city,
+        'startDate': str(conf.startDate) if conf.startDate else None,
+        'endDate': str(conf.endDate) if conf.endDate else None,
+        'maxAttendees': conf.maxAttendees,
+        'seatsAvailable': conf.seatsAvailable,
+    }
+
+
+def _sessionToDict(sess):
+    return {
+        'websafeKey': sess.key.urlsafe(),
+        'sessionName': sess.sessionName,
+        'highlights': sess.highlights,
+        'speaker': sess.speaker,
+        'typeOfSession': sess.typeOfSession,
+        'sessionDate': str(sess.sessionDate),
+        'startTime': sess.startTime.strftime('%H%M'),
+        'duration': sess.duration,
+    }
+
+
+def _writeCsv(writer, conf, sessions):
+    """Conference row followed by its session rows."""
+    row = _conferenceToDict(conf)
+    row['kind'] = 'conference'
+    row['topics'] = '|'.join(conf.topics)
+    writer.writerow(_encodeRow(row))
+    for sess in sessions:
+        row = _sessionToDict(sess)
+        row['kind'] = 'session'
+        writer.writerow(_encodeRow(row))
+
+
+# - - - Attendee roster - - - - - - - - - - - - - - - - - - -
+
+def exportRoster(out, wsck, cursor=None, fmt='jsonl', max_pages=ROSTER_MAX_PAGES):
+    """Write the attendees registered for a conference to out, a page
+    at a time; memory is bounded by the page size, however many attend.
+
+    Registrations are found with a keys-only query on the built-in index
+    of Profile.conferenceKeysToAttend. Returns the cursor to continue
+    from, or None when done.
+    """
+    q = repo.query(Profile, Profile.conferenceKeysToAttend == wsck)
+    writer = None
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, ROSTER_COLUMNS)
+        if not cursor:
+            writer.writerow(dict(zip(ROSTER_COLUMNS, ROSTER_COLUMNS)))
+
+    for _ in range(max_pages):
+        keys, cursor = q.fetchPage(ROSTER_PAGE_SIZE, cursor, keysOnly=True)
+        for i in range(0, len(keys), ROSTER_GET_BATCH):
+            for prof in repo.getMulti(keys[i:i + ROSTER_GET_BATCH], useCache=False):
+                if not prof:
+                    continue
+                row = _attendeeToDict(prof)
+                if writer:
+                    writer.writerow(_encodeRow(row))
+                else:
+                    out.write(json.dumps(row) + '\n')
+        if not cursor:
+            return None
+    return cursor
+
+
+def _attendeeToDict(prof):
+    return {
+        'userId': prof.key.id(),
+        'displayName': prof.displayName,
+        'mainEmail': prof.mainEmail,
+        'teeShirtSize': prof.teeShirtSize,
+    }
+
+
+def _encodeRow(row):
+    """csv in Python 2 writes bytes, so encode unicode values."""
+    return dict((k, v.encode('utf-8') if isinstance(v, unicode) else v)
+                for k, v in row.items() if v is not None)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Conference Central instance-local (L1) cache in front of memcache, and
+memcache token buckets for admission control, and a most-requested
+keys tracker
+
+Entries live in a bounded, thread-safe LRU with a TTL. Each entry is
+tagged with the generation number of its namespace, kept in memcache;
+a write on any instance bumps the generation, and every instance
+re-reads generations at most GENERATION_CHECK_SECONDS apart, so stale
+L1 entries elsewhere are dropped within that window. The memcache copy
+of an entry is keyed by generation too, so a value loaded before a
+write can't be written back over it.
+
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+L1_MAX_ENTRIES = 1000
+L1_TTL_SECONDS = 60
+GENERATION_CHECK_SECONDS = 5
+GENERATION_KEY_TPL = 'L1 GENERATION %s'
+MEMCACHE_KEY_TPL = '%s @%d'     # key, generation
+MEMCACHE_TTL_SECONDS = 3600     # loaded values; bounds orphaned generations
+
+_MISSING = object()
+
+
+class InstanceCache(object):
+    """Bounded LRU cache with TTLs and memcache generation invalidation."""
+
+    def __init__(self, max_entries=L1_MAX_ENTRIES, ttl=L1_TTL_SECONDS,
+                 generation_check=GENERATION_CHECK_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation_check = generation_check
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (value, expires, namespace, gen)
+        self._generations = {}          # namespace -> (gen, checked_at)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, namespace, loader=None):
+        """Return key from this instance, else memcache, else loader().
+
+        Misses are cached too, so an absent value costs no RPC either.
+        """
+        gen = self._generation(namespace)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and entry[1] > now and entry[2] == namespace and entry[3] == gen:
+                self._entries[key] = entry      # most recently used
+                self.hits += 1
+                return None if entry[0] is _MISSING else entry[0]
+            self.misses += 1
+
+        mkey = MEMCACHE_KEY_TPL % (key, gen)
+        value = memcache.get(mkey)
+        if value is None and loader:
+            value = loader()
+            if value is not None:
+                # under the generation read before loading, so a write
+                # that raced the load orphans the value it read
+                memcache.add(mkey, value, time=MEMCACHE_TTL_SECONDS)
+        self._store(key, _MISSING if value is None else value, namespace, gen)
+        return value
+
+    def set(self, key, value, namespace):
+        """Write value through to memcache and invalidate other instances."""
+        gen = self.invalidate(namespace)
+        memcache.set(MEMCACHE_KEY_TPL % (key, gen), value)
+        self._store(key, value, namespace, gen)
+
+    def delete(self, key, namespace):
+        """Delete key from memcache and invalidate other instances."""
+        self._store(key, _MISSING, namespace, self.invalidate(namespace, key))
+
+    def invalidate(self, namespace, *keys):
+        """Bump the namespace generation, dropping its L1 entries and their
+        memcache copies everywhere; the memcache copies of keys are deleted
+        now, the rest expire. Returns the new generation.
+        """
+        gen = memcache.incr(GENERATION_KEY_TPL % namespace)
+        if gen is None:
+            gen = self._initGeneration(namespace)
+        elif keys:
+            memcache.delete_multi([MEMCACHE_KEY_TPL % (key, gen - 1) for key in keys])
+        with self._lock:
+            self._generations[namespace] = (gen, time.time())
+        return gen
+
+    def generation(self, namespace):
+        """Current generation of namespace; put it in the keys of values
+        cached in memcache only, so that invalidate() orphans them too.
+        """
+        return self._generation(namespace)
+
+    def stats(self):
+        """Size, hit rate and eviction counters for this instance."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxEntries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+    def _store(self, key, value, namespace, gen):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl, namespace, gen)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _generation(self, namespace):
+        """Namespace generation, re-read from memcache when out of date."""
+        now = time.time()
+        with self._lock:
+            cached = self._generations.get(namespace)
+        if cached and now - cached[1] < self.generation_check:
+            return cached[0]
+        gen = memcache.get(GENERATION_KEY_TPL % namespace)
+        if gen is None:
+            gen = self._initGeneration(namespace)
+        with self._lock:
+            self._generations[namespace] = (gen, now)
+        return gen
+
+    @staticmethod
+    def _initGeneration(namespace):
+        """Start a lost or new generation from the clock, so it can't
+        fall back to a number that older entries were tagged with.
+        """
+        key = GENERATION_KEY_TPL % namespace
+        memcache.add(key, int(time.time() * 1000))
+        return memcache.get(key)
+
+
+def takeToken(key, capacity, rate, retries=5):
+    """Take a token from a token bucket kept in memcache under key.
+
+    The bucket holds up to capacity tokens and refills at rate tokens per
+    second. Returns False when it is empty, or when compare-and-set keeps
+    losing to other requests, which only happens under heavy load.
+    """
+    client = memcache.Client()
+    for _ in range(retries):
+        now = time.time()
+        state = client.gets(key)
+        if state is None:
+            if client.add(key, (capacity - 1, now)):
+                return True
+            continue
+        tokens, last = state
+        tokens = min(capacity, tokens + (now - last) * rate)
+        if tokens < 1:
+            return False
+        if client.cas(key, (tokens - 1, now)):
+            return True
+    return False
+
+
+class HotKeys(object):
+    """Approximate most-requested keys across instances.
+
+    Hits are counted per instance and merged into one memcache dict every
+    flush_every hits, with compare-and-set. Only the max_keys most hit
+    keys are kept, so rarely requested keys drop out.
+    """
+
+    def __init__(self, key, max_keys=50, flush_every=100):
+        self.key = key
+        self.max_keys = max_keys
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._pending = 0
+
+    def hit(self, name):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+            self._pending += 1
+            if self._pending < self.flush_every:
+                return
+            counts, self._counts, self._pending = self._counts, {}, 0
+        self._merge(counts)
+
+    def top(self, n):
+        """The n most hit keys, most hit first."""
+        counts = memcache.get(self.key) or {}
+        return sorted(counts, key=counts.get, reverse=True)[:n]
+
+    def _merge(self, counts, retries=5):
+        client = memcache.Client()
+        for _ in range(retries):
+            merged = client.gets(self.key)
+            if merged is None:
+                if client.add(self.key, self._trim(counts)):
+                    return
+                continue
+            for name, n in counts.items():
+                merged[name] = merged.get(name, 0) + n
+            if client.cas(self.key, self._trim(merged)):
+                return
+
+    def _trim(self, counts):
+        if len(counts) <= self.max_keys:
+            return counts
+        keep = sorted(counts, key=counts.get, reverse=True)[:self.max_keys]
+        return dict((name, counts[name]) for name in keep)
+
+
+# one cache per instance, shared by all request threads
+l1 = InstanceCache()
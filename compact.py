@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""compact.py
+
+Conference Central columnar encoding for large list responses
+
+Each field is sent once as a CompactColumn of parallel arrays, built
+straight from entities without per-item form messages. Repeated values
+(enums, dates, cities, speakers) are dictionary encoded: the column holds
+the distinct values once and an index per item. List fields also carry
+the length of each item's list. static/js/compact.js decodes a
+CompactForms back into one object per item.
+
+"""
+
+from models import CompactColumn
+from models import CompactForms
+
+STRING = 'string'   # one string per item; None becomes ''
+INT = 'int'         # one integer per item; None becomes 0
+DICT = 'dict'       # dictionary index per item
+LIST = 'list'       # dictionary indexes of every item's list, plus lengths
+
+
+def encodeColumns(entities, columns):
+    """Encode entities as a CompactForms.
+
+    columns -- list of (name, encoding, getter); getter maps an entity
+    to the field value.
+    """
+    entities = list(entities)
+    return CompactForms(
+        count=len(entities),
+        columns=[_encodeColumn(name, encoding, [getter(e) for e in entities])
+                 for name, encoding, getter in columns]
+    )
+
+
+def _encodeColumn(name, encoding, values):
+    col = CompactColumn(name=name)
+    if encoding == STRING:
+        col.strings = [v or '' for v in values]
+    elif encoding == INT:
+        col.ints = [v or 0 for v in values]
+    else:
+        if encoding == LIST:
+            col.lengths = [len(v or []) for v in values]
+            values = [x for v in values for x in (v or [])]
+        index = {}
+        col.ints = [index.setdefault('' if v is None else v, len(index)) for v in values]
+        col.dictionary = sorted(index, key=index.get)
+    return col
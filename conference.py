@@ -15,11 +15,18 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 from datetime import datetime
 from datetime import time
+from datetime import timedelta
 
+import calendar
+import hashlib
+import heapq
+import json
 import logging
+import uuid
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
 from google.appengine.api import memcache
@@ -28,7 +35,10 @@ from google.appengine.ext import ndb
 from google.appengine.ext.db import stats
 
 from models import ConflictException
+from models import SoldOutException
+from models import TooManyRequestsException
 from models import Profile
+from models import putChanged
 from models import ProfileMiniForm
 from models import ProfileForm
 from models import StringMessage
@@ -36,13 +46,40 @@ from models import BooleanMessage
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
+from models import ConferencePageForm
+from models import ConferenceBatchItem
+from models import ConferenceBatchForms
+from models import WebsafeKeysForm
+from models import CompactForms
+from models import ConferenceDashboard
+from models import ConferenceDashboardForm
+from models import CountForm
+from models import WaitlistEntry
+from models import WaitlistForm
+from models import RegistrationStatus
+from models import RegistrationTicket
+from models import RegistrationTicketForm
+from models import SweepCheckpoint
+from models import ConferenceDeletion
+from models import IdempotencyRecord
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
 from models import TeeShirtSize
 from models import Session
 from models import SessionForm
 from models import SessionForms
+from models import SessionNowNextForm
+from models import AgendaPageForm
+from models import SessionPageForm
+from models import SessionBatchItem
+from models import SessionBatchForms
+from models import WishlistAddForm
+from models import WishlistConflictForm
+from models import WishlistConflictForms
 from models import SessionType
+from models import SpeakerCounter
+from models import SpeakerLeaderboard
+from models import TopSpeakersForm
 
 
 from settings import WEB_CLIENT_ID
@@ -51,6 +88,18 @@ from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 
 from utils import getUserId
+from cache import l1
+from cache import takeToken
+from cache import HotKeys
+from profiling import profiled
+from repository import repo
+from repository import transactional
+from repository import BadCursorError
+from intervals import IntervalIndex
+from intervals import SortedIntervals
+from intervals import sessionInterval
+from intervals import toMinutes
+import compact
 
 logging.getLogger().setLevel(logging.DEBUG)
 
@@ -60,9 +109,89 @@ MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
 MEMCACHE_SPEAKER_KEY = "FEATURED SPEAKER"
+MEMCACHE_CONFERENCE_TPL = "CONFERENCE %s"
+MEMCACHE_SESSION_INDEX_TPL = "SESSION INDEX %s"
+ANNOUNCEMENTS_NAMESPACE = 'announcements'
+SPEAKER_NAMESPACE = 'featured speaker'
+CONFERENCE_NAMESPACE_TPL = 'conference %s'
+SESSION_INDEX_NAMESPACE_TPL = 'session index %s'
+CONFIRMATION_EMAIL_QUEUE = 'confirmation-email'
+FEATURED_SPEAKER_DEBOUNCE_SECONDS = 30
+WAITLIST_PROMOTE_DEBOUNCE_SECONDS = 5
+WAITLIST_PROMOTE_BATCH = 20     # profiles per cross-group transaction
+DASHBOARD_ID = 'dashboard'
+DASHBOARD_REBUILD_DEBOUNCE_SECONDS = 10
+REGISTRATION_QUEUE = 'registrations'
+REGISTRATION_BATCH = 20         # registrations per cross-group transaction
+REGISTRATION_LEASE_SECONDS = 60
+REGISTRATION_DRAIN_DEBOUNCE_SECONDS = 1
+ADMISSION_KEY_TPL = "ADMISSION %s"
+MAX_BATCH_KEYS = 100            # keys per getConferences/getSessions call
+AGENDA_PAGE_SIZE = 25
+AGENDA_MAX_PAGE_SIZE = 100
+MEMCACHE_UPCOMING_TPL = "UPCOMING %s|%s|%s|%d"
+MEMCACHE_CONFERENCE_QUERY_TPL = "CONFERENCE QUERY %s %s"
+CONFERENCE_QUERY_NAMESPACE = 'conference queries'
+CONFERENCE_QUERY_CACHE_MAX_BYTES = 900000   # under memcache's 1MB value limit
+MEMCACHE_SEATS_TPL = "SEATS %s"
+SEATS_CACHE_SECONDS = 300       # bounds drift of a seat count that missed an update
+UPCOMING_PAGE_SIZE = 20
+UPCOMING_MAX_PAGE_SIZE = 100
+UPCOMING_CACHE_SECONDS = 30     # first pages are served this stale at most
+PROFILE_SWEEP_ID = 'profiles'
+PROFILE_SWEEP_BATCH = 100       # profiles per sweep task
+PROFILE_SWEEP_DELAY_SECONDS = 2 # pause between sweep tasks
+PROFILE_SWEEP_STALE_SECONDS = 3600
+CONFERENCE_DELETE_BATCH = 100   # sessions per cascade task
+CONFERENCE_DELETE_STALE_SECONDS = 600
+ADMISSION_BUCKET_SIZE = 100     # burst of registration requests admitted
+ADMISSION_REFILL_PER_SECOND = 20
+HOT_CONFERENCES_KEY = "HOT CONFERENCES"
+MEMCACHE_SPEAKER_LEADERBOARD_KEY = "SPEAKER LEADERBOARD"
+SPEAKER_LEADERBOARD_NAMESPACE = 'speaker leaderboard'
+SPEAKER_LEADERBOARD_ID = 'speakers'
+SPEAKER_LEADERBOARD_SIZE = 100  # speakers kept per ranking
+SPEAKER_LEADERBOARD_DEBOUNCE_SECONDS = 60
+SPEAKER_RECOUNT_DEBOUNCE_SECONDS = 10
+TOP_SPEAKERS_DEFAULT = 10
+SESSION_SEARCH_PAGE_SIZE = 20
+SESSION_SEARCH_MAX_PAGE_SIZE = 100
+SESSION_COPY_BATCH = 100        # sessions per conference fields copy task
+SESSION_COPY_DEBOUNCE_SECONDS = 5
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MEMCACHE_IDEMPOTENCY_TPL = "IDEMPOTENCY %s"
+IDEMPOTENCY_PENDING = 'pending'
+IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+IDEMPOTENCY_PENDING_SECONDS = 60   # a create taking longer is treated as failed
+IDEMPOTENCY_MAX_KEY_LENGTH = 128
+IDEMPOTENCY_EXPIRE_BATCH = 500
 FEATURED_SPEAKER_ANNOUNCEMENT_TPL = ('Featured speaker for this conference is %s.'
                     ' The sessions that feature this speaker are %s !' 
                     ' Please plan on atending them.')
+# columns of the compact list responses, see compact.py
+SESSION_COLUMNS = [
+    ('websafeKey', compact.STRING, lambda sess: sess.key.urlsafe()),
+    ('sessionName', compact.STRING, lambda sess: sess.sessionName),
+    ('highlights', compact.STRING, lambda sess: sess.highlights),
+    ('speaker', compact.DICT, lambda sess: sess.speaker),
+    ('typeOfSession', compact.DICT, lambda sess: sess.typeOfSession),
+    ('sessionDate', compact.DICT, lambda sess: str(sess.sessionDate)),
+    ('startTime', compact.INT, lambda sess: sess.startTime.hour * 100 + sess.startTime.minute),
+    ('duration', compact.INT, lambda sess: sess.duration),
+]
+CONFERENCE_COLUMNS = [
+    ('websafeKey', compact.STRING, lambda conf: conf.key.urlsafe()),
+    ('name', compact.STRING, lambda conf: conf.name),
+    ('description', compact.STRING, lambda conf: conf.description),
+    ('organizerUserId', compact.DICT, lambda conf: conf.organizerUserId),
+    ('topics', compact.LIST, lambda conf: conf.topics),
+    ('city', compact.DICT, lambda conf: conf.city),
+    ('startDate', compact.DICT, lambda conf: str(conf.startDate)),
+    ('endDate', compact.DICT, lambda conf: str(conf.endDate)),
+    ('month', compact.INT, lambda conf: conf.month),
+    ('maxAttendees', compact.INT, lambda conf: conf.maxAttendees),
+    ('seatsAvailable', compact.INT, lambda conf: conf.seatsAvailable),
+]
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -105,16 +234,75 @@ SESSION_POST_WISHLIST_REQUEST = endpoints.ResourceContainer(
     websafeSessionKey=messages.StringField(1)
 )
 
+SESSION_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeSessionKey=messages.StringField(1),
+)
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
 )
 
+TICKET_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ticket=messages.StringField(1),
+)
+
 SESSION_SPEAKER_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1),
 )
 
+SESSION_WINDOW_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    sessionDate=messages.StringField(2),
+    startTime=messages.IntegerField(3),
+    endTime=messages.IntegerField(4),
+)
+
+SESSION_NOW_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    sessionDate=messages.StringField(2),
+    startTime=messages.IntegerField(3),
+)
+
+AGENDA_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    sessionDate=messages.StringField(2),
+    typeOfSession=messages.StringField(3),
+    cursor=messages.StringField(4),
+    pageSize=messages.IntegerField(5),
+)
+
+UPCOMING_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    city=messages.StringField(1),
+    topic=messages.StringField(2),
+    cursor=messages.StringField(3),
+    pageSize=messages.IntegerField(4),
+)
+
+TOP_SPEAKERS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    limit=messages.IntegerField(1),
+    typeOfSession=messages.StringField(2),
+    month=messages.IntegerField(3),
+)
+
+SESSION_SEARCH_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    typeOfSession=messages.StringField(1),
+    city=messages.StringField(2),
+    month=messages.IntegerField(3),
+    topic=messages.StringField(4),
+    cursor=messages.StringField(5),
+    pageSize=messages.IntegerField(6),
+)
+
 SESSION_TYPE_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     typeOfSession=messages.StringField(1),
@@ -150,8 +338,9 @@ class ConferenceApi(remote.Service):
         return cf
 
 
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning ConferenceForm/request."""
+    def _createConferenceObject(self, request, record=None):
+        """Create or update Conference object, returning ConferenceForm/request;
+        record(form) returns entities to write in the same transaction."""
         # preload necessary data items
         user = endpoints.get_current_user()
         if not user:
@@ -187,22 +376,35 @@ class ConferenceApi(remote.Service):
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
+        c_id = repo.allocateIds(Conference, 1, parent=p_key)
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email'
-        )
+        # create Conference & its empty dashboard, send email to organizer
+        # confirming creation of Conference & return (modified) ConferenceForm
+        entities = [Conference(**data), ConferenceDashboard(
+            key=self._dashboardKey(c_key), maxAttendees=data['maxAttendees'])]
+        repo.transaction(lambda: repo.putMulti(
+            entities + (record(request) if record else [])), xg=True)
+        self._invalidateConferenceQueries()
+        # queue the email on a pull queue; the send_confirmation_emails
+        # cron leases these in batches. Naming the task after the
+        # conference keeps a conference from being queued twice.
+        try:
+            taskqueue.Queue(CONFIRMATION_EMAIL_QUEUE).add(taskqueue.Task(
+                name='confirm-%s' % c_key.urlsafe(),
+                method='PULL',
+                payload=json.dumps({'email': user.email(),
+                    'websafeConferenceKey': c_key.urlsafe(),
+                    'conferenceInfo': repr(request)})
+            ))
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
         return request
 
 
-    @ndb.transactional()
+    @transactional()
     def _updateConferenceObject(self, request):
         user = endpoints.get_current_user()
         if not user:
@@ -213,7 +415,7 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
 
         # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = repo.get(ndb.Key(urlsafe=request.websafeConferenceKey))
         # check that conference exists
         if not conf:
             raise endpoints.NotFoundException(
@@ -226,6 +428,7 @@ class ConferenceApi(remote.Service):
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
+        oldMaxAttendees = conf.maxAttendees or 0
         for field in request.all_fields():
             data = getattr(request, field.name)
             # only copy fields where we get data
@@ -237,16 +440,27 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
-        conf.put()
-        prof = ndb.Key(Profile, user_id).get()
+        # a capacity change moves seatsAvailable along with it, unless
+        # seatsAvailable was set explicitly
+        if request.maxAttendees is not None and request.seatsAvailable is None:
+            conf.seatsAvailable = max(0,
+                (conf.seatsAvailable or 0) + conf.maxAttendees - oldMaxAttendees)
+        # skip the write (& its index updates) for a no-op update
+        changed = conf.changedProperties()
+        if changed:
+            repo.put(conf)
+        if 'maxAttendees' in changed:
+            self._adjustDashboard(conf.key, maxAttendees=conf.maxAttendees)
+        prof = repo.get(ndb.Key(Profile, user_id))
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
     def createConference(self, request):
-        """Create new conference."""
-        return self._createConferenceObject(request)
+        """Create new conference; retries sending the same Idempotency-Key header get the original conference."""
+        return self._idempotent('createConference', ConferenceForm,
+            lambda record: self._createConferenceObject(request, record))
 
 
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
@@ -254,7 +468,46 @@ class ConferenceApi(remote.Service):
             http_method='PUT', name='updateConference')
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        cf = self._updateConferenceObject(request)
+        self._invalidateConference(request.websafeConferenceKey)
+        self._invalidateConferenceQueries(request.websafeConferenceKey)
+        # sessions carry copies of the fields they are searched by
+        if request.city or request.topics or request.startDate:
+            self._queueCopyConferenceFields(request.websafeConferenceKey)
+        # added capacity goes to the waitlist first
+        if request.maxAttendees is not None and cf.seatsAvailable > 0:
+            self._queuePromoteWaitlist(request.websafeConferenceKey)
+        return cf
+
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+            path='conference/delete/{websafeConferenceKey}',
+            http_method='DELETE', name='deleteConference')
+    def deleteConference(self, request):
+        """Delete a conference; its sessions are deleted in the background. Organizer only."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        wsck = request.websafeConferenceKey
+        try:
+            conf_key = ndb.Key(urlsafe=wsck)
+        except:
+            raise endpoints.BadRequestException('Conference not found for key: %s' % wsck)
+        if conf_key.kind() != 'Conference' or conf_key.parent() is None:
+            raise endpoints.BadRequestException('Conference not found for key: %s' % wsck)
+        # the conference key's parent is its organizer's Profile
+        if conf_key.parent().id() != getUserId(user):
+            raise endpoints.ForbiddenException(
+                'Only the owner can delete the conference.')
+        if not self._deleteConferenceObject(conf_key):
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+
+        self._invalidateConference(wsck)
+        self._invalidateConferenceQueries(wsck)
+        self._invalidateSessionIndex(wsck)
+        self._queueSessionDeletion(wsck, 0)
+        return BooleanMessage(data=True)
 
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
@@ -262,14 +515,138 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
+        # get Conference object & organizer name, through the instance
+        # cache; bail if not found
+        wsck = request.websafeConferenceKey
+        cached = self._cachedConference(wsck)
+        if not cached:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+                'No conference found with key: %s' % wsck)
+        hotConferences.hit(wsck)
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return self._copyConferenceToForm(*cached)
+
+
+    @staticmethod
+    def _cachedConference(wsck):
+        """(Conference, organizer displayName) through the instance cache,
+        or None."""
+        def load():
+            conf = repo.get(ndb.Key(urlsafe=wsck))
+            if conf:
+                prof = repo.get(conf.key.parent())
+                return (conf, getattr(prof, 'displayName'))
+        return l1.get(MEMCACHE_CONFERENCE_TPL % wsck,
+                      CONFERENCE_NAMESPACE_TPL % wsck, load)
+
+
+    @staticmethod
+    def _preloadConferences(limit):
+        """Load the most viewed conferences into the instance cache;
+        returns how many were loaded. Used by the warmup handler.
+        """
+        loaded = 0
+        for wsck in hotConferences.top(limit):
+            try:
+                if ConferenceApi._cachedConference(wsck):
+                    loaded += 1
+            except Exception:
+                logging.warning('Could not preload conference %s', wsck)
+        return loaded
+
+
+    @staticmethod
+    def _decodeKeys(websafeKeys, kind):
+        """Decode websafe keys once; keys that are malformed or of another
+        kind come back as None.
+        """
+        if len(websafeKeys) > MAX_BATCH_KEYS:
+            raise endpoints.BadRequestException(
+                'At most %d keys may be requested at once' % MAX_BATCH_KEYS)
+        keys = []
+        for wsk in websafeKeys:
+            try:
+                key = ndb.Key(urlsafe=wsk)
+            except:
+                key = None
+            keys.append(key if key and key.kind() == kind.__name__ else None)
+        return keys
+
+
+    @endpoints.method(WebsafeKeysForm, ConferenceBatchForms,
+            path='conferences/batch',
+            http_method='POST', name='getConferences')
+    def getConferences(self, request):
+        """Return conferences for a list of websafe keys, in order, marking the ones not found."""
+        keys = self._decodeKeys(request.websafeKeys, Conference)
+        conferences = repo.getMulti([key for key in keys if key])
+        found = dict((conf.key, conf) for conf in conferences if conf)
+
+        # one get_multi for the distinct organizers
+        organisers = list(set(conf.key.parent() for conf in found.values()))
+        names = dict((prof.key, prof.displayName)
+                     for prof in repo.getMulti(organisers) if prof)
+
+        items = []
+        for wsk, key in zip(request.websafeKeys, keys):
+            conf = found.get(key)
+            if conf:
+                items.append(ConferenceBatchItem(websafeKey=wsk, found=True,
+                    conference=self._copyConferenceToForm(conf, names.get(key.parent()))))
+            else:
+                items.append(ConferenceBatchItem(websafeKey=wsk, found=False))
+        return ConferenceBatchForms(items=items)
+
+
+    @staticmethod
+    def _invalidateConference(wsck):
+        """Drop a conference from memcache & every instance cache; call
+        after the write has committed.
+        """
+        l1.invalidate(CONFERENCE_NAMESPACE_TPL % wsck, MEMCACHE_CONFERENCE_TPL % wsck)
+
+
+    @staticmethod
+    def _invalidateConferenceQueries(wsck=None):
+        """Orphan every cached queryConferences result, and drop the seat
+        count of wsck, if given; call after conferences are created or
+        updated.
+        """
+        l1.invalidate(CONFERENCE_QUERY_NAMESPACE)
+        if wsck:
+            # seat counts are plain memcache keys, outside the namespace
+            memcache.delete(MEMCACHE_SEATS_TPL % wsck)
+
+
+    @staticmethod
+    def _adjustCachedSeats(wsck, delta):
+        """Apply a committed change in seatsAvailable to the conference's
+        seat count in memcache, if it has one; registrations keep cached
+        query results current this way, without invalidating them.
+        """
+        if delta > 0:
+            memcache.incr(MEMCACHE_SEATS_TPL % wsck, delta)
+        elif delta < 0:
+            memcache.decr(MEMCACHE_SEATS_TPL % wsck, -delta)
+
+
+    @staticmethod
+    def _refreshSeats(forms):
+        """Set seatsAvailable of ConferenceForms from the seat counts in
+        memcache; counts not there are read from the datastore & added.
+        """
+        byKey = dict((MEMCACHE_SEATS_TPL % cf.websafeKey, cf) for cf in forms)
+        seats = memcache.get_multi(byKey.keys())
+        missing = [key for key in byKey if key not in seats]
+        if missing:
+            confs = repo.getMulti([ndb.Key(urlsafe=byKey[key].websafeKey) for key in missing])
+            loaded = dict((key, conf.seatsAvailable) for key, conf in zip(missing, confs)
+                          if conf and conf.seatsAvailable is not None)
+            memcache.add_multi(loaded, time=SEATS_CACHE_SECONDS)
+            seats.update(loaded)
+        for key, cf in byKey.items():
+            if key in seats:
+                cf.seatsAvailable = seats[key]
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
@@ -285,8 +662,8 @@ class ConferenceApi(remote.Service):
         user_id = getUserId(user)
 
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs = repo.query(Conference, ancestor=ndb.Key(Profile, user_id))
+        prof = repo.get(ndb.Key(Profile, user_id))
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
             items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
@@ -295,8 +672,12 @@ class ConferenceApi(remote.Service):
 
     def _getQuery(self, request):
         """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
+        return self._conferenceQuery(*self._canonicalFilters(request.filters))
+
+
+    def _conferenceQuery(self, inequality_filter, filters):
+        """Return the query for canonical filters."""
+        q = repo.query(Conference)
 
         # If exists, sort on inequality filter first
         if not inequality_filter:
@@ -305,14 +686,29 @@ class ConferenceApi(remote.Service):
             q = q.order(ndb.GenericProperty(inequality_filter))
             q = q.order(Conference.name)
 
-        for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
+        for field, operator, value in filters:
+            formatted_query = ndb.query.FilterNode(field, operator, value)
             q = q.filter(formatted_query)
         return q
 
 
+    def _canonicalFilters(self, filters):
+        """Return the inequality field & the user supplied filters as
+        sorted, deduplicated (field, operator, value) tuples, so that
+        equivalent filter lists come out equal.
+        """
+        inequality_filter, formatted_filters = self._formatFilters(filters)
+        canonical = set()
+        for filtr in formatted_filters:
+            if filtr["field"] in ["month", "maxAttendees"]:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException("Filter on %s needs a number." % filtr["field"])
+            canonical.add((filtr["field"], filtr["operator"], filtr["value"]))
+        return (inequality_filter, sorted(canonical))
+
+
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
         formatted_filters = []
@@ -346,13 +742,38 @@ class ConferenceApi(remote.Service):
             http_method='POST',
             name='queryConferences')
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
+        """Query for conferences; equivalent filter lists share one cached result."""
+        inequality_filter, filters = self._canonicalFilters(request.filters)
+        # the generation changes whenever a conference is created or updated
+        key = MEMCACHE_CONFERENCE_QUERY_TPL % (l1.generation(CONFERENCE_QUERY_NAMESPACE),
+                                               hashlib.sha1(json.dumps(filters)).hexdigest())
+        loaded = []
+        def load():
+            loaded.append(self._queryConferenceForms(
+                self._conferenceQuery(inequality_filter, filters)))
+            encoded = protojson.encode_message(loaded[0])
+            # results too large for memcache are not cached at all
+            return encoded if len(encoded) <= CONFERENCE_QUERY_CACHE_MAX_BYTES else None
+        encoded = l1.get(key, CONFERENCE_QUERY_NAMESPACE, load)
+        if encoded is not None:
+            forms = protojson.decode_message(ConferenceForms, encoded)
+        elif loaded:
+            forms = loaded[0]
+        else:
+            forms = self._queryConferenceForms(
+                self._conferenceQuery(inequality_filter, filters))
+        self._refreshSeats(forms.items)
+        return forms
+
+
+    def _queryConferenceForms(self, q):
+        """Run a conference query into ConferenceForms."""
+        conferences = q.fetch()
 
         # need to fetch organiser displayName from profiles
         # get all keys and use get_multi for speed
         organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        profiles = repo.getMulti(organisers)
 
         # put display names in a dict for easier fetching
         names = {}
@@ -366,6 +787,138 @@ class ConferenceApi(remote.Service):
         )
 
 
+    @endpoints.method(ConferenceQueryForms, CompactForms,
+            path='queryConferences/compact',
+            http_method='POST',
+            name='queryConferencesCompact')
+    def queryConferencesCompact(self, request):
+        """Query for conferences; columnar response, see compact.py."""
+        conferences = self._getQuery(request).fetch()
+
+        # one get_multi for the distinct organizers' display names
+        organisers = list(set(ndb.Key(Profile, conf.organizerUserId) for conf in conferences))
+        names = dict((profile.key.id(), profile.displayName)
+                     for profile in repo.getMulti(organisers) if profile)
+
+        return compact.encodeColumns(conferences, CONFERENCE_COLUMNS + [
+            ('organizerDisplayName', compact.DICT,
+             lambda conf: names.get(conf.organizerUserId)),
+        ])
+
+
+    @endpoints.method(UPCOMING_GET_REQUEST, ConferencePageForm,
+            path='conferences/upcoming',
+            http_method='GET', name='getUpcomingConferences')
+    def getUpcomingConferences(self, request):
+        """Return a page of conferences starting today or later, soonest first, optionally in one city or on one topic.
+
+        Pass nextCursor back, with the same filters, for the next page. First pages are cached for a few seconds.
+        """
+        pageSize = min(request.pageSize or UPCOMING_PAGE_SIZE, UPCOMING_MAX_PAGE_SIZE)
+        today = datetime.utcnow().date()
+
+        if request.cursor:
+            try:
+                conferences, nextCursor = self._upcomingPage(today, request.city, request.topic, pageSize, request.cursor)
+            except BadCursorError:
+                raise endpoints.BadRequestException('Invalid cursor')
+        else:
+            # key on the day too, so yesterday's conferences drop out at midnight
+            key = MEMCACHE_UPCOMING_TPL % (today, request.city or '', request.topic or '', pageSize)
+            page = memcache.get(key)
+            if page is None:
+                page = self._upcomingPage(today, request.city, request.topic, pageSize)
+                memcache.set(key, page, time=UPCOMING_CACHE_SECONDS)
+            conferences, nextCursor = page
+
+        organisers = list(set(ndb.Key(Profile, conf.organizerUserId) for conf in conferences))
+        names = dict((profile.key.id(), profile.displayName)
+                     for profile in repo.getMulti(organisers) if profile)
+        return ConferencePageForm(
+            items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+                   for conf in conferences],
+            nextCursor=nextCursor
+        )
+
+
+    @staticmethod
+    def _upcomingPage(today, city, topic, pageSize, start=None):
+        """(conferences, websafe next cursor or None) from today on."""
+        # index-served: [city ,] [topics ,] startDate
+        q = repo.query(Conference, Conference.startDate >= today)
+        if city:
+            q = q.filter(Conference.city == city)
+        if topic:
+            q = q.filter(Conference.topics == topic)
+        q = q.order(Conference.startDate)
+        return q.fetchPage(pageSize, start)
+
+
+# - - - Idempotent creates - - - - - - - - - - - - - - - - - -
+
+    def _idempotent(self, method, form_class, create):
+        """Return create(record), or the response already recorded for the
+        client's Idempotency-Key header, if any, for this user & method.
+
+        create writes the entities record(response) returns in the
+        transaction that creates, so a request that dies after committing
+        is still recorded. Responses are kept in memcache & the datastore
+        for a day. A key whose first request is still running gets a
+        ConflictException.
+        """
+        key = self.request_state.headers.get(IDEMPOTENCY_HEADER)
+        user = endpoints.get_current_user()
+        if not key or not user:
+            return create(None)
+        if len(key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+            raise endpoints.BadRequestException('%s must be at most %d characters'
+                % (IDEMPOTENCY_HEADER, IDEMPOTENCY_MAX_KEY_LENGTH))
+        record_id = '%s:%s:%s' % (getUserId(user), method, key)
+        mkey = MEMCACHE_IDEMPOTENCY_TPL % record_id
+
+        encoded = memcache.get(mkey)
+        if encoded is None:
+            record = repo.get(ndb.Key(IdempotencyRecord, record_id))
+            if record and record.expires > datetime.utcnow():
+                encoded = record.response
+        if encoded == IDEMPOTENCY_PENDING or (encoded is None and
+                not memcache.add(mkey, IDEMPOTENCY_PENDING, time=IDEMPOTENCY_PENDING_SECONDS)):
+            raise ConflictException('A request with this %s is still in progress' % IDEMPOTENCY_HEADER)
+        if encoded is not None:
+            return protojson.decode_message(form_class, encoded)
+
+        def record(response):
+            return [IdempotencyRecord(id=record_id,
+                response=protojson.encode_message(response),
+                expires=datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS))]
+        try:
+            response = create(record)
+        except:
+            # if the create committed, the retry finds its record
+            memcache.delete(mkey)
+            raise
+        memcache.set(mkey, protojson.encode_message(response), time=IDEMPOTENCY_TTL_SECONDS)
+        return response
+
+
+    @staticmethod
+    def _expireIdempotencyRecords(cursor=None):
+        """Delete a page of expired idempotency records & queue the next;
+        returns how many were deleted.
+
+        Offset cursors (sqlite) skip past records as the earlier pages go;
+        the next cron run picks those up.
+        """
+        keys, nextCursor = repo.query(IdempotencyRecord,
+            IdempotencyRecord.expires < datetime.utcnow()
+            ).fetchPage(IDEMPOTENCY_EXPIRE_BATCH, cursor, keysOnly=True)
+        repo.deleteMulti(keys)
+        if nextCursor:
+            taskqueue.add(params={'cursor': nextCursor},
+                          url='/tasks/expire_idempotency_keys')
+        return len(keys)
+
+
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
@@ -393,7 +946,7 @@ class ConferenceApi(remote.Service):
         # get Profile from datastore
         user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        profile = repo.get(p_key)
         # create new Profile if not there
         if not profile:
             profile = Profile(
@@ -402,7 +955,7 @@ class ConferenceApi(remote.Service):
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
+            repo.put(profile)
 
         return profile      # return Profile
 
@@ -423,7 +976,8 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-                        prof.put()
+            # one write for all fields, and none if nothing changed
+            prof.putIfChanged()
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -450,37 +1004,53 @@ class ConferenceApi(remote.Service):
         """Create Announcement & assign to memcache; used by
         memcache cron job & putAnnouncement().
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
+        announcement = ConferenceApi._announcementText()
+        if announcement:
             # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+            # set the announcement in memcache
+            l1.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement, ANNOUNCEMENTS_NAMESPACE)
         else:
             # If there are no sold out conferences,
             # delete the memcache announcements entry
             announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+            l1.delete(MEMCACHE_ANNOUNCEMENTS_KEY, ANNOUNCEMENTS_NAMESPACE)
 
         return announcement
 
 
+    @staticmethod
+    def _announcementText():
+        """Announcement of the nearly sold out conferences, or None."""
+        confs = repo.query(Conference, ndb.AND(
+            Conference.seatsAvailable <= 5,
+            Conference.seatsAvailable > 0)
+        ).fetch(projection=[Conference.name])
+        if confs:
+            return ANNOUNCEMENT_TPL % (
+                ', '.join(conf.name for conf in confs))
+
+
+    @staticmethod
+    def _primeAnnouncement():
+        """Read the announcement into the instance cache, computing it if
+        memcache has none; unlike _cacheAnnouncement, other instances'
+        caches are left alone.
+        """
+        return l1.get(MEMCACHE_ANNOUNCEMENTS_KEY, ANNOUNCEMENTS_NAMESPACE,
+                      ConferenceApi._announcementText)
+
+
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        """Return Announcement from the instance cache or memcache."""
+        return StringMessage(data=l1.get(MEMCACHE_ANNOUNCEMENTS_KEY, ANNOUNCEMENTS_NAMESPACE) or "")
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
+    @transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
         retval = None
@@ -489,7 +1059,7 @@ class ConferenceApi(remote.Service):
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = repo.get(ndb.Key(urlsafe=wsck))
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
@@ -503,7 +1073,7 @@ class ConferenceApi(remote.Service):
 
             # check if seats avail
             if conf.seatsAvailable <= 0:
-                raise ConflictException(
+                raise SoldOutException(
                     "There are no seats available.")
 
             # register user, take away one seat
@@ -523,9 +1093,10 @@ class ConferenceApi(remote.Service):
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        # write changed entities back to the datastore in one batch & return
+        putChanged([prof, conf])
+        if retval:
+            self._adjustDashboard(conf.key, registrations=1 if reg else -1)
         return BooleanMessage(data=retval)
 
 
@@ -536,19 +1107,22 @@ class ConferenceApi(remote.Service):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
         conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        # skip keys of conferences that no longer exist; the profile
+        # sweeper removes them from the profile
+        conferences = [conf for conf in repo.getMulti(conf_keys) if conf]
 
         # get organizers
         organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        profiles = repo.getMulti(organisers)
 
         # put display names in a dict for easier fetching
         names = {}
         for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+            if profile:
+                names[profile.key.id()] = profile.displayName
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
+        return ConferenceForms(items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId))\
          for conf in conferences]
         )
 
@@ -557,8 +1131,18 @@ class ConferenceApi(remote.Service):
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
     def registerForConference(self, request):
-        """Register user for selected conference."""
-        return self._conferenceRegistration(request)
+        """Register user for selected conference; when it is sold out,
+        put the user on its waitlist instead.
+        """
+        try:
+            retval = self._conferenceRegistration(request)
+        except SoldOutException:
+            position = self._joinWaitlist(request.websafeConferenceKey)
+            raise ConflictException(
+                "There are no seats available. You are number %d on the waitlist." % position)
+        self._invalidateConference(request.websafeConferenceKey)
+        self._adjustCachedSeats(request.websafeConferenceKey, -1)
+        return retval
 
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
@@ -566,7 +1150,398 @@ class ConferenceApi(remote.Service):
             http_method='DELETE', name='unregisterFromConference')
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
-        return self._conferenceRegistration(request, reg=False)
+        retval = self._conferenceRegistration(request, reg=False)
+        self._invalidateConference(request.websafeConferenceKey)
+        if retval.data:
+            # the freed seat goes to the waitlist
+            self._adjustCachedSeats(request.websafeConferenceKey, 1)
+            self._queuePromoteWaitlist(request.websafeConferenceKey)
+        else:
+            # not registered, so leave the waitlist if on it
+            user_id = getUserId(endpoints.get_current_user())
+            repo.delete(ndb.Key(WaitlistEntry, '%s:%s' % (request.websafeConferenceKey, user_id)))
+        return retval
+
+
+# - - - Organizer dashboard - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _dashboardKey(conf_key):
+        return ndb.Key(ConferenceDashboard, DASHBOARD_ID, parent=conf_key)
+
+
+    @staticmethod
+    def _adjustDashboard(conf_key, registrations=0, sessions=(), maxAttendees=None, delta=1):
+        """Apply an incremental change to a conference dashboard, counting
+        sessions delta times each; call in the transaction that makes the
+        change. Dashboards that were never built are left for
+        _rebuildDashboard.
+        """
+        dash = repo.get(ConferenceApi._dashboardKey(conf_key))
+        if not dash:
+            return
+        dash.registrations += registrations
+        for session in sessions:
+            dash.sessionCount += delta
+            for attr, value in (('sessionTypeCounts', session.typeOfSession),
+                                ('speakerCounts', session.speaker)):
+                counts = dict(getattr(dash, attr) or {})
+                counts[value] = counts.get(value, 0) + delta
+                if counts[value] <= 0:
+                    del counts[value]
+                setattr(dash, attr, counts)
+        if maxAttendees is not None:
+            dash.maxAttendees = maxAttendees
+        repo.put(dash)
+
+
+    @staticmethod
+    @transactional()
+    def _rebuildDashboard(wsck):
+        """Recount a conference dashboard from its sessions & seats; return
+        it, or None if the conference does not exist.
+        """
+        conf_key = ndb.Key(urlsafe=wsck)
+        conf = repo.get(conf_key)
+        if not conf:
+            return None
+        typeCounts = {}
+        speakerCounts = {}
+        sessionCount = 0
+        for sess in repo.query(Session, ancestor=conf_key):
+            sessionCount += 1
+            typeCounts[sess.typeOfSession] = typeCounts.get(sess.typeOfSession, 0) + 1
+            speakerCounts[sess.speaker] = speakerCounts.get(sess.speaker, 0) + 1
+        dash = ConferenceDashboard(key=ConferenceApi._dashboardKey(conf_key),
+            sessionCount=sessionCount,
+            sessionTypeCounts=typeCounts,
+            speakerCounts=speakerCounts,
+            registrations=(conf.maxAttendees or 0) - (conf.seatsAvailable or 0),
+            maxAttendees=conf.maxAttendees or 0)
+        repo.put(dash)
+        return dash
+
+
+    @staticmethod
+    def _queueDashboardRebuild(wsck):
+        """Queue one dashboard rebuild per conference per debounce window."""
+        ConferenceApi._addDebouncedTask('rebuild-dashboard-%s' % wsck,
+            '/tasks/rebuild_dashboard', {'websafeConferenceKey': wsck},
+            DASHBOARD_REBUILD_DEBOUNCE_SECONDS)
+
+
+    @endpoints.method(CONF_GET_REQUEST, ConferenceDashboardForm,
+            path='conference/{websafeConferenceKey}/dashboard',
+            http_method='GET', name='getConferenceDashboard')
+    def getConferenceDashboard(self, request):
+        """Return session, speaker & registration totals for a conference; organizer only."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        wsck = request.websafeConferenceKey
+        try:
+            conf_key = ndb.Key(urlsafe=wsck)
+        except:
+            raise endpoints.BadRequestException('Conference not found for key: %s' % wsck)
+        # the conference key's parent is its organizer's Profile
+        if conf_key.parent() is None or conf_key.parent().id() != getUserId(user):
+            raise endpoints.ForbiddenException(
+                'Only the owner can see the conference dashboard.')
+
+        dash = repo.get(self._dashboardKey(conf_key)) or self._rebuildDashboard(wsck)
+        if not dash:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+
+        def countForms(counts):
+            return [CountForm(name=name, count=count) for name, count in
+                    sorted((counts or {}).items(), key=lambda item: -item[1])]
+        return ConferenceDashboardForm(
+            websafeConferenceKey=wsck,
+            sessionCount=dash.sessionCount,
+            sessionTypeCounts=countForms(dash.sessionTypeCounts),
+            speakerCount=len(dash.speakerCounts or {}),
+            speakerCounts=countForms(dash.speakerCounts),
+            registrations=dash.registrations,
+            maxAttendees=dash.maxAttendees,
+            seatsAvailable=dash.maxAttendees - dash.registrations,
+            fillRate=float(dash.registrations) / dash.maxAttendees if dash.maxAttendees else 0.0,
+        )
+
+
+# - - - Waitlist - - - - - - - - - - - - - - - - - - - - - -
+
+    def _joinWaitlist(self, wsck):
+        """Add the current user to a conference waitlist, once; return
+        their 1-based position.
+        """
+        user_id = getUserId(endpoints.get_current_user())
+        entry = repo.getOrInsert(WaitlistEntry, '%s:%s' % (wsck, user_id),
+            websafeConferenceKey=wsck, userId=user_id)
+        return self._waitlistPosition(entry)
+
+
+    @staticmethod
+    def _waitlistPosition(entry):
+        """1-based FIFO position of a waitlist entry."""
+        return repo.query(WaitlistEntry,
+            WaitlistEntry.websafeConferenceKey == entry.websafeConferenceKey,
+            WaitlistEntry.enqueued < entry.enqueued).count() + 1
+
+
+    @endpoints.method(CONF_GET_REQUEST, WaitlistForm,
+            path='conference/{websafeConferenceKey}/waitlist',
+            http_method='POST', name='joinWaitlist')
+    def joinWaitlist(self, request):
+        """Join the waitlist of a sold out conference."""
+        conf = repo.get(ndb.Key(urlsafe=request.websafeConferenceKey))
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        return WaitlistForm(websafeConferenceKey=request.websafeConferenceKey,
+                            position=self._joinWaitlist(request.websafeConferenceKey))
+
+
+    @endpoints.method(CONF_GET_REQUEST, WaitlistForm,
+            path='conference/{websafeConferenceKey}/waitlist',
+            http_method='GET', name='getWaitlistPosition')
+    def getWaitlistPosition(self, request):
+        """Return the user's position on a conference waitlist, 0 if not on it."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        wsck = request.websafeConferenceKey
+        entry = repo.get(ndb.Key(WaitlistEntry, '%s:%s' % (wsck, getUserId(user))))
+        return WaitlistForm(websafeConferenceKey=wsck,
+                            position=self._waitlistPosition(entry) if entry else 0)
+
+
+    @staticmethod
+    def _queuePromoteWaitlist(wsck):
+        """Queue one waitlist promotion per conference per debounce window."""
+        ConferenceApi._addDebouncedTask('promote-waitlist-%s' % wsck,
+            '/tasks/promote_waitlist', {'websafeConferenceKey': wsck},
+            WAITLIST_PROMOTE_DEBOUNCE_SECONDS)
+
+
+    @staticmethod
+    def _promoteWaitlist(wsck):
+        """Register waiting users, oldest first, while seats remain.
+
+        The waitlist query is eventually consistent, so each batch starts
+        after the last one rather than trusting its deletes to be indexed.
+        """
+        seen = set()
+        last = None
+        while True:
+            q = repo.query(WaitlistEntry, WaitlistEntry.websafeConferenceKey == wsck)
+            if last:
+                # entries enqueued in the same instant are told apart by key
+                q = q.filter(WaitlistEntry.enqueued >= last)
+            entries = [entry for entry in q.order(WaitlistEntry.enqueued).fetch(
+                WAITLIST_PROMOTE_BATCH + len(seen)) if entry.key not in seen]
+            entries = entries[:WAITLIST_PROMOTE_BATCH]
+            if not entries:
+                return
+            outcomes = ConferenceApi._registerBatch(wsck, [entry.userId for entry in entries])
+            repo.deleteMulti([entry.key for entry, outcome in zip(entries, outcomes)
+                              if outcome != 'SOLD_OUT'])
+            registered = outcomes.count('REGISTERED')
+            ConferenceApi._invalidateConference(wsck)
+            ConferenceApi._adjustCachedSeats(wsck, -registered)
+            # a batch of users already registered still moves on
+            if 'SOLD_OUT' in outcomes or len(entries) < WAITLIST_PROMOTE_BATCH:
+                return
+            if entries[-1].enqueued != last:
+                seen = set()
+            last = entries[-1].enqueued
+            seen.update(entry.key for entry in entries if entry.enqueued == last)
+
+
+    @staticmethod
+    @transactional(xg=True)
+    def _registerBatch(wsck, userIds):
+        """Register several users for a conference in one transaction.
+
+        Returns an outcome per user id: REGISTERED, ALREADY_REGISTERED,
+        SOLD_OUT or NOT_FOUND (no such conference or profile). Keep
+        userIds to at most 24 distinct users, the cross-group limit.
+        """
+        conf = repo.get(ndb.Key(urlsafe=wsck))
+        if not conf:
+            return ['NOT_FOUND'] * len(userIds)
+        profiles = dict((prof.key.id(), prof) for prof in
+            repo.getMulti([ndb.Key(Profile, uid) for uid in set(userIds)]) if prof)
+        changed = {}
+        outcomes = []
+        for uid in userIds:
+            prof = profiles.get(uid)
+            if not prof:
+                outcomes.append('NOT_FOUND')
+            elif wsck in prof.conferenceKeysToAttend:
+                outcomes.append('ALREADY_REGISTERED')
+            elif conf.seatsAvailable <= 0:
+                outcomes.append('SOLD_OUT')
+            else:
+                prof.conferenceKeysToAttend.append(wsck)
+                conf.seatsAvailable -= 1
+                changed[uid] = prof
+                outcomes.append('REGISTERED')
+        if changed:
+            repo.putMulti([conf] + changed.values())
+            ConferenceApi._adjustDashboard(conf.key, registrations=len(changed))
+        return outcomes
+
+
+# - - - Dangling reference sweeper - - - - - - - - - - - - -
+
+    @staticmethod
+    def _startProfileSweep():
+        """Start the profile sweep from its checkpoint, unless one is
+        already running.
+        """
+        checkpoint = repo.getOrInsert(SweepCheckpoint, PROFILE_SWEEP_ID)
+        if checkpoint.running and \
+                datetime.utcnow() - checkpoint.updated < timedelta(seconds=PROFILE_SWEEP_STALE_SECONDS):
+            return
+        checkpoint.running = True
+        repo.put(checkpoint)
+        taskqueue.add(params={'cursor': checkpoint.cursor or ''},
+                      url='/tasks/sweep_profiles')
+
+
+    @staticmethod
+    def _sweepProfiles(cursor):
+        """Remove missing conferences & sessions from one page of Profiles,
+        checkpoint, and queue the next page after a pause.
+        """
+        profiles, nextCursor = repo.query(Profile).fetchPage(
+            PROFILE_SWEEP_BATCH, cursor or None)
+
+        # one get_multi for every key referenced by the page
+        refs = set()
+        for prof in profiles:
+            refs.update(prof.conferenceKeysToAttend)
+            refs.update(prof.SessionsInWishlist)
+        refs = list(refs)
+        found = repo.getMulti([ndb.Key(urlsafe=ref) for ref in refs])
+        missing = set(ref for ref, entity in zip(refs, found) if not entity)
+
+        for prof in profiles:
+            if missing.intersection(prof.conferenceKeysToAttend) or \
+                    missing.intersection(prof.SessionsInWishlist):
+                ConferenceApi._removeDanglingKeys(prof.key, missing)
+
+        checkpoint = repo.getOrInsert(SweepCheckpoint, PROFILE_SWEEP_ID)
+        checkpoint.cursor = nextCursor
+        checkpoint.running = bool(nextCursor)
+        repo.put(checkpoint)
+        if nextCursor:
+            taskqueue.add(params={'cursor': checkpoint.cursor},
+                          countdown=PROFILE_SWEEP_DELAY_SECONDS,
+                          url='/tasks/sweep_profiles')
+
+
+    @staticmethod
+    @transactional()
+    def _removeDanglingKeys(p_key, missing):
+        """Drop missing keys from a Profile, re-read in a transaction so
+        concurrent registrations are kept.
+        """
+        prof = repo.get(p_key)
+        keep = [i for i, ses in enumerate(prof.wishlistSlotKeys) if ses not in missing]
+        prof.wishlistStarts = [prof.wishlistStarts[i] for i in keep]
+        prof.wishlistEnds = [prof.wishlistEnds[i] for i in keep]
+        prof.wishlistSlotKeys = [prof.wishlistSlotKeys[i] for i in keep]
+        prof.conferenceKeysToAttend = [wsck for wsck in prof.conferenceKeysToAttend
+                                       if wsck not in missing]
+        prof.SessionsInWishlist = [ses for ses in prof.SessionsInWishlist
+                                   if ses not in missing]
+        repo.put(prof)
+
+
+# - - - Asynchronous registration - - - - - - - - - - - - - -
+
+    @endpoints.method(CONF_GET_REQUEST, RegistrationTicketForm,
+            path='conference/{websafeConferenceKey}/registration',
+            http_method='POST', name='requestRegistration')
+    def requestRegistration(self, request):
+        """Queue a registration for a conference & return a ticket to poll."""
+        prof = self._getProfileFromUser()
+        wsck = request.websafeConferenceKey
+        if wsck in prof.conferenceKeysToAttend:
+            raise ConflictException(
+                "You have already registered for this conference")
+        if not takeToken(ADMISSION_KEY_TPL % wsck, ADMISSION_BUCKET_SIZE,
+                         ADMISSION_REFILL_PER_SECOND):
+            raise TooManyRequestsException(
+                'Too many registrations for this conference right now; please retry shortly.')
+
+        ticket = RegistrationTicket(id=uuid.uuid4().hex,
+            websafeConferenceKey=wsck, userId=prof.key.id())
+        repo.put(ticket)
+        taskqueue.Queue(REGISTRATION_QUEUE).add(taskqueue.Task(
+            payload=ticket.key.id(), method='PULL', tag=wsck))
+        ConferenceApi._addDebouncedTask('drain-registrations-%s' % wsck,
+            '/tasks/drain_registrations', {'websafeConferenceKey': wsck},
+            REGISTRATION_DRAIN_DEBOUNCE_SECONDS)
+        return self._copyTicketToForm(ticket)
+
+
+    @endpoints.method(TICKET_GET_REQUEST, RegistrationTicketForm,
+            path='registration/{ticket}',
+            http_method='GET', name='getRegistrationTicket')
+    def getRegistrationTicket(self, request):
+        """Return the status of a queued registration."""
+        ticket = repo.get(ndb.Key(RegistrationTicket, request.ticket))
+        if not ticket:
+            raise endpoints.NotFoundException(
+                'No registration found with ticket: %s' % request.ticket)
+        return self._copyTicketToForm(ticket)
+
+
+    def _copyTicketToForm(self, ticket):
+        """Copy relevant fields from RegistrationTicket to RegistrationTicketForm."""
+        tf = RegistrationTicketForm(
+            ticket=ticket.key.id(),
+            websafeConferenceKey=ticket.websafeConferenceKey,
+            status=getattr(RegistrationStatus, ticket.status),
+        )
+        tf.check_initialized()
+        return tf
+
+
+    @staticmethod
+    def _drainRegistrations(wsck):
+        """Apply queued registrations for a conference, a batch per transaction."""
+        queue = taskqueue.Queue(REGISTRATION_QUEUE)
+        while True:
+            tasks = queue.lease_tasks_by_tag(REGISTRATION_LEASE_SECONDS,
+                                             REGISTRATION_BATCH, tag=wsck)
+            if not tasks:
+                return
+            # if this drain dies holding the lease, retries of its task
+            # find nothing to lease; this one runs once the lease is up
+            ConferenceApi._addDebouncedTask('redrain-registrations-%s' % wsck,
+                '/tasks/drain_registrations', {'websafeConferenceKey': wsck},
+                REGISTRATION_LEASE_SECONDS, delay=REGISTRATION_LEASE_SECONDS)
+            tickets = [t for t in repo.getMulti(
+                [ndb.Key(RegistrationTicket, task.payload) for task in tasks]) if t]
+            outcomes = ConferenceApi._registerBatch(wsck, [t.userId for t in tickets])
+
+            # sold out users wait for a seat on the waitlist
+            waiting = [ndb.Key(WaitlistEntry, '%s:%s' % (wsck, t.userId))
+                       for t, outcome in zip(tickets, outcomes) if outcome == 'SOLD_OUT']
+            repo.putMulti([WaitlistEntry(key=key, websafeConferenceKey=wsck,
+                userId=key.id().rsplit(':', 1)[1])
+                for key, entry in zip(waiting, repo.getMulti(waiting)) if not entry])
+
+            for ticket, outcome in zip(tickets, outcomes):
+                ticket.status = 'WAITLISTED' if outcome == 'SOLD_OUT' else outcome
+            repo.putMulti(tickets)
+            queue.delete_tasks(tasks)
+            ConferenceApi._invalidateConference(wsck)
+            ConferenceApi._adjustCachedSeats(wsck, -outcomes.count('REGISTERED'))
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
@@ -574,7 +1549,7 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='filterPlayground')
     def filterPlayground(self, request):
         """Filter Playground"""
-        q = Conference.query()
+        q = repo.query(Conference)
         # field = "city"
         # operator = "="
         # value = "London"
@@ -618,7 +1593,14 @@ class ConferenceApi(remote.Service):
             path='session',
             http_method='POST', name='createSession')
     def createSession(self, request):
-        """Create new session for a given conference"""
+        """Create new session for a given conference; retries sending the same Idempotency-Key header get the original session."""
+        return self._idempotent('createSession', SessionForm,
+            lambda record: self._createSessionObject(request, record))
+
+
+    def _createSessionObject(self, request, record=None):
+        """Create new session for a given conference; record(form) returns
+        entities to write in the same transaction."""
 
         # Make sure user is authorized
 	user = endpoints.get_current_user()
@@ -640,11 +1622,12 @@ class ConferenceApi(remote.Service):
             
         # get conference from websafeconference key in a try catch block
 	try:
-	    conf = ndb.Key(urlsafe=request.websafeConferenceKey).get() 
+	    conf = repo.get(ndb.Key(urlsafe=request.websafeConferenceKey))
 	        
 	except:
             raise endpoints.BadRequestException('No conference found with key: %s' % request.websafeConferenceKey)
-            
+        if not conf:
+            raise endpoints.NotFoundException('No conference found with key: %s' % request.websafeConferenceKey)
             
         # Validate that user is also the organizer of the conference
         if user_id != conf.organizerUserId:
@@ -668,36 +1651,46 @@ class ConferenceApi(remote.Service):
         
         # Generate Session Key based on the conference key
         p_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-	s_id = Session.allocate_ids(size=1, parent=p_key)[0]
+	s_id = repo.allocateIds(Session, 1, parent=p_key)
 	s_key = ndb.Key(Session, s_id, parent=p_key)
 	data['key'] = s_key       
 
 ############# TASK 4 ::  Creating a Task Queue for capturing a speaker that speaks more than once in a Conference [aka Featured Speaker] #############
 
         # When a new session is created, kick off a task which caches speakers that participate in more than one Session.
-        
-        #logging.debug("createSession :: About to add taskqueue with websafeconference %s",request.websafeConferenceKey )
-        
-        taskqueue.add(
-            params={
-                'websafeConferenceKey': request.websafeConferenceKey,
-                'speaker': data['speaker']
-                },
-            url='/tasks/cache_featured_speaker'
-            )
+        # Sessions created within the same debounce window share one task.
+        self._queueFeaturedSpeaker(request.websafeConferenceKey)
 
         
         #logging.debug("createSession :: About to insert into session")
 
         # Get the session object into the datastore
         session = Session(**data)
-        session.put()
+        self._putSession(session, record)
+        self._invalidateSessionIndex(request.websafeConferenceKey)
+        self._queueSpeakerRecount(session.speaker)
 
         # return SessionForm
         return self._copySessionToForm(session)        
      
  
   
+    @transactional(xg=True)
+    def _putSession(self, session, record=None):
+        """Write a new session, with its conference's search fields, & count
+        it on its conference dashboard."""
+        # read in the transaction, so a concurrent conference update
+        # either is copied here or fans out to this session after, and
+        # a concurrent deletion leaves no orphan
+        conf = repo.get(session.key.parent())
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % session.key.parent().urlsafe())
+        self._copyConferenceFields(conf, session)
+        repo.putMulti([session] + (record(self._copySessionToForm(session)) if record else []))
+        self._adjustDashboard(session.key.parent(), sessions=[session])
+
+
 ########## TASK 1 :: getConferenceSessions        #############
 
     @endpoints.method(CONF_GET_REQUEST, SessionForms,
@@ -708,12 +1701,12 @@ class ConferenceApi(remote.Service):
         #logging.debug("getConferenceSessions:: About to query Conference")
         # try and catch conferences that do not exist
         try:
-            conf = ndb.Key(urlsafe=request.websafeConferenceKey).get() 
+            conf = repo.get(ndb.Key(urlsafe=request.websafeConferenceKey))
         except:
             raise endpoints.BadRequestException('Conference not found for key: %s' % request.websafeConferenceKey)
         
         # Ancestor query
-        sessions = Session.query(ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
+        sessions = repo.query(Session, ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
         #logging.debug("getConferenceSessions:: Ancestor queried Successfully")
         #for sess in sessions:
             #logging.debug("Session Name is %s", sess.sessionName) 
@@ -723,6 +1716,174 @@ class ConferenceApi(remote.Service):
             items=[self._copySessionToForm(sess) for sess in sessions]
         )
 
+############# Session time windows  #############
+
+    @staticmethod
+    def _sessionIndex(wsck):
+        """Return the interval index over a conference's sessions, building
+        it from an ancestor query when it is not cached.
+
+        Payloads are session ids, not sessions, so that the index of a
+        large conference stays well under memcache's value limit; get the
+        sessions with _indexedSessions.
+        """
+        def load():
+            try:
+                sessions = repo.query(Session, ancestor=ndb.Key(urlsafe=wsck))
+            except:
+                raise endpoints.BadRequestException('Conference not found for key: %s' % wsck)
+            return IntervalIndex(sessionInterval(sess) + (sess.key.id(),) for sess in sessions)
+        return l1.get(MEMCACHE_SESSION_INDEX_TPL % wsck,
+                      SESSION_INDEX_NAMESPACE_TPL % wsck, load)
+
+
+    @staticmethod
+    def _indexedSessions(wsck, ids):
+        """Sessions of a conference by id, in order, with one get_multi;
+        sessions deleted since the index was built are left out.
+        """
+        conf_key = ndb.Key(urlsafe=wsck)
+        sessions = repo.getMulti([ndb.Key(Session, id, parent=conf_key) for id in ids])
+        return [sess for sess in sessions if sess]
+
+
+    @staticmethod
+    def _invalidateSessionIndex(wsck):
+        """Drop a conference's session index after its sessions change."""
+        l1.invalidate(SESSION_INDEX_NAMESPACE_TPL % wsck, MEMCACHE_SESSION_INDEX_TPL % wsck)
+
+
+    def _parseSessionMinute(self, sessionDate, startTime):
+        """Convert YYYY-MM-DD and HHMM request values to index minutes."""
+        try:
+            day = datetime.strptime(sessionDate[:10], '%Y-%m-%d').date()
+        except:
+            raise endpoints.BadRequestException('Make sure your Session Date is in the format YYYY-MM-DD. For example 2016-01-17.')
+        try:
+            start = datetime.strptime(str(startTime).zfill(4)[:4], '%H%M').time()
+        except:
+            raise endpoints.BadRequestException('Make sure your Start Time is in the format HHMM. For example 0830')
+        return toMinutes(day, start)
+
+
+    @endpoints.method(SESSION_WINDOW_GET_REQUEST, SessionForms,
+            path='sessions/window/{websafeConferenceKey}',
+            http_method='GET', name='getSessionsInTimeWindow')
+    def getSessionsInTimeWindow(self, request):
+        """Return sessions of a conference running between startTime and endTime on sessionDate."""
+        if not request.sessionDate or request.startTime is None or request.endTime is None:
+            raise endpoints.BadRequestException('sessionDate, startTime and endTime are required')
+        start = self._parseSessionMinute(request.sessionDate, request.startTime)
+        end = self._parseSessionMinute(request.sessionDate, request.endTime)
+        if end <= start:
+            raise endpoints.BadRequestException('endTime must be after startTime')
+
+        wsck = request.websafeConferenceKey
+        sessions = self._indexedSessions(wsck, self._sessionIndex(wsck).overlapping(start, end))
+        return SessionForms(
+            items=[self._copySessionToForm(sess) for sess in sessions]
+        )
+
+
+    @endpoints.method(SESSION_NOW_GET_REQUEST, SessionNowNextForm,
+            path='sessions/nowNext/{websafeConferenceKey}',
+            http_method='GET', name='getSessionsNowAndNext')
+    def getSessionsNowAndNext(self, request):
+        """Return sessions running now and those starting next; sessionDate and startTime default to the current UTC time."""
+        now = datetime.utcnow()
+        minute = self._parseSessionMinute(request.sessionDate or str(now.date()),
+            request.startTime if request.startTime is not None else now.strftime('%H%M'))
+
+        wsck = request.websafeConferenceKey
+        index = self._sessionIndex(wsck)
+        now = index.at(minute)
+        sessions = self._indexedSessions(wsck, now + index.startingAfter(minute))
+        return SessionNowNextForm(
+            now=[self._copySessionToForm(sess) for sess in sessions if sess.key.id() in now],
+            next=[self._copySessionToForm(sess) for sess in sessions if sess.key.id() not in now]
+        )
+
+    @endpoints.method(WebsafeKeysForm, SessionBatchForms,
+            path='sessions/batch',
+            http_method='POST', name='getSessions')
+    def getSessions(self, request):
+        """Return sessions for a list of websafe keys, in order, marking the ones not found."""
+        keys = self._decodeKeys(request.websafeKeys, Session)
+        found = dict((sess.key, sess) for sess in
+                     repo.getMulti([key for key in keys if key]) if sess)
+
+        items = []
+        for wsk, key in zip(request.websafeKeys, keys):
+            sess = found.get(key)
+            if sess:
+                items.append(SessionBatchItem(websafeKey=wsk, found=True,
+                    session=self._copySessionToForm(sess)))
+            else:
+                items.append(SessionBatchItem(websafeKey=wsk, found=False))
+        return SessionBatchForms(items=items)
+
+    @endpoints.method(CONF_GET_REQUEST, CompactForms,
+            path='sessions/compact/{websafeConferenceKey}',
+            http_method='GET', name='getConferenceSessionsCompact')
+    def getConferenceSessionsCompact(self, request):
+        """Return all sessions of a conference; columnar response, see compact.py."""
+        try:
+            sessions = repo.query(Session, ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
+        except:
+            raise endpoints.BadRequestException('Conference not found for key: %s' % request.websafeConferenceKey)
+        return compact.encodeColumns(sessions, SESSION_COLUMNS)
+
+############# Conference agenda  #############
+
+    @endpoints.method(AGENDA_GET_REQUEST, AgendaPageForm,
+            path='sessions/agenda/{websafeConferenceKey}',
+            http_method='GET', name='getConferenceAgenda')
+    def getConferenceAgenda(self, request):
+        """Return a page of a conference's sessions in time order, from sessionDate on; a page never spans two days.
+
+        Pass nextCursor back, with the same sessionDate and typeOfSession, for the next page, which may be the next day.
+        """
+        try:
+            conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        except:
+            raise endpoints.BadRequestException('Conference not found for key: %s' % request.websafeConferenceKey)
+        pageSize = min(request.pageSize or AGENDA_PAGE_SIZE, AGENDA_MAX_PAGE_SIZE)
+
+        # index-served: ancestor [, typeOfSession] , sessionDate, startTime
+        q = repo.query(Session, ancestor=conf_key)
+        if request.typeOfSession:
+            if request.typeOfSession not in SessionType.names():
+                raise endpoints.BadRequestException('Unknown typeOfSession: %s' % request.typeOfSession)
+            q = q.filter(Session.typeOfSession == request.typeOfSession)
+        if request.sessionDate:
+            try:
+                day = datetime.strptime(request.sessionDate[:10], '%Y-%m-%d').date()
+            except:
+                raise endpoints.BadRequestException('Make sure your Session Date is in the format YYYY-MM-DD. For example 2016-01-17.')
+            q = q.filter(Session.sessionDate >= day)
+        q = q.order(Session.sessionDate, Session.startTime)
+
+        # stop at the page size, or before the first session of the next day
+        sessions = []
+        nextCursor = None
+        cursor = None
+        try:
+            for sess, after in q.iterWithCursors(request.cursor, batchSize=pageSize + 1):
+                if sessions and (len(sessions) == pageSize or
+                                 sess.sessionDate != sessions[0].sessionDate):
+                    nextCursor = cursor
+                    break
+                sessions.append(sess)
+                cursor = after
+        except BadCursorError:
+            raise endpoints.BadRequestException('Invalid cursor')
+
+        return AgendaPageForm(
+            sessionDate=str(sessions[0].sessionDate) if sessions else None,
+            items=[self._copySessionToForm(sess) for sess in sessions],
+            nextCursor=nextCursor
+        )
+
 ############# TASK 1 ::  getSessionsBySpeaker      #############
 
     @endpoints.method(SESSION_SPEAKER_GET_REQUEST, SessionForms,
@@ -732,7 +1893,7 @@ class ConferenceApi(remote.Service):
         """Return sessions where the speaker is the one passed in the request."""
         
         # Query Session based on Speaker
-        sessions = Session.query(Session.speaker == request.speaker)
+        sessions = repo.query(Session, Session.speaker == request.speaker)
         
         # SessionForm objects per session
         return SessionForms(
@@ -749,12 +1910,12 @@ class ConferenceApi(remote.Service):
         
         # try and catch conferences that do not exist
         try:
-            conf = ndb.Key(urlsafe=request.websafeConferenceKey).get() 
+            conf = repo.get(ndb.Key(urlsafe=request.websafeConferenceKey))
         except:
             raise endpoints.BadRequestException('Conference not found for key: %s' % request.websafeConferenceKey)
         
         # Ancestor query
-        q = Session.query(ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
+        q = repo.query(Session, ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
         sessions = q.filter(Session.typeOfSession == request.typeOfSession)
         
         
@@ -766,7 +1927,7 @@ class ConferenceApi(remote.Service):
 
 ############# TASK 2 ::  addSessionToWishlist #############
 
-    @ndb.transactional(xg=True)
+    @transactional(xg=True)
     def _addSessionToWishlist(self, request):
         """Adds the session to the user's list of sessions they are interested in attending."""
        
@@ -778,7 +1939,7 @@ class ConferenceApi(remote.Service):
         # Get profile of user from Profile datastore
 	user_id = getUserId(user)
 	p_key = ndb.Key(Profile, user_id)
-	profile = p_key.get()
+	profile = repo.get(p_key)
 	
 	# Create new Profile if it does not exist already
 	if not profile:
@@ -788,14 +1949,16 @@ class ConferenceApi(remote.Service):
 	                mainEmail= user.email(),
 	                teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
 	            )
-	    profile.put()
+	    # written below, together with the wishlist change
 
         # Get websafesession key from request and raise hell if it does not resolve to a valid session       
         ses_key = request.websafeSessionKey      
         try:
-            sess = ndb.Key(urlsafe=ses_key).get() 
+            sess = repo.get(ndb.Key(urlsafe=ses_key))
         except:
             raise endpoints.BadRequestException('No session found with key: %s' % ses_key)
+        if not sess:
+            raise endpoints.NotFoundException('No session found with key: %s' % ses_key)
         
         
         # Check if user is already added session to Wishlist 
@@ -803,16 +1966,65 @@ class ConferenceApi(remote.Service):
             raise ConflictException(
                   "This Session has been already added to WishList")
 
+        # Find wishlist sessions overlapping this one, then add its slot
+        slots = self._wishlistSlots(profile)
+        start, end = sessionInterval(sess)
+        conflicts = slots.overlapping(start, end)
+        slots.add(start, end, ses_key)
+        profile.wishlistMaxMinutes = slots.maxLength
+
         # Add to WishList
         profile.SessionsInWishlist.append(ses_key)
         retval = True
 
         # Write to Profile datastore & return
-        profile.put()
-        return BooleanMessage(data=True)
+        repo.put(profile)
+        return WishlistAddForm(data=True, conflicts=conflicts)
 
 
-    @endpoints.method(SESSION_POST_WISHLIST_REQUEST, BooleanMessage,
+    @staticmethod
+    def _wishlistSlotsStale(profile):
+        """Whether the profile's wishlist slots need rebuilding."""
+        return len(profile.wishlistSlotKeys) != len(profile.SessionsInWishlist)
+
+
+    @staticmethod
+    def _wishlistSlots(profile):
+        """Return the profile's wishlist time slots as SortedIntervals,
+        rebuilding them for wishlists saved before slots were kept; deleted
+        sessions are dropped from the wishlist while rebuilding.
+        """
+        if ConferenceApi._wishlistSlotsStale(profile):
+            sessions = repo.getMulti([ndb.Key(urlsafe=ses) for ses in profile.SessionsInWishlist])
+            profile.SessionsInWishlist = [ses for ses, sess in
+                zip(profile.SessionsInWishlist, sessions) if sess]
+            slots = IntervalIndex(sessionInterval(sess) + (ses,)
+                for ses, sess in zip(profile.SessionsInWishlist, filter(None, sessions)))
+            profile.wishlistStarts = slots.starts
+            profile.wishlistEnds = slots.ends
+            profile.wishlistSlotKeys = slots.payloads
+            profile.wishlistMaxMinutes = slots.maxLength
+        return SortedIntervals(profile.wishlistStarts, profile.wishlistEnds,
+                               profile.wishlistSlotKeys, profile.wishlistMaxMinutes)
+
+
+    @staticmethod
+    @transactional()
+    def _saveWishlistSlots(rebuilt, wishlist):
+        """Save wishlist slots rebuilt from wishlist onto the stored profile,
+        re-read in a transaction so concurrent changes are kept; a wishlist
+        changed since is left for its next rebuild.
+        """
+        profile = repo.get(rebuilt.key)
+        if profile.SessionsInWishlist != wishlist:
+            return
+        for attr in ('SessionsInWishlist', 'wishlistStarts', 'wishlistEnds',
+                     'wishlistSlotKeys', 'wishlistMaxMinutes'):
+            setattr(profile, attr, getattr(rebuilt, attr))
+        repo.put(profile)
+
+
+    @endpoints.method(SESSION_POST_WISHLIST_REQUEST, WishlistAddForm,
             path='wishlist/add/{websafeSessionKey}',
             http_method='POST', name='addSessionToWishlist')
     def addSessionToWishlist(self, request):
@@ -821,7 +2033,7 @@ class ConferenceApi(remote.Service):
 
 ############# TASK 2 ::  deleteSessionFromWishlist #############
 
-    @ndb.transactional(xg=True)
+    @transactional(xg=True)
     def _deleteSessionFromWishlist(self, request):
         """Deletes the session from the user's list of sessions they are interested in attending."""
        
@@ -833,7 +2045,7 @@ class ConferenceApi(remote.Service):
         # Get profile of user from Profile datastore
 	user_id = getUserId(user)
 	p_key = ndb.Key(Profile, user_id)
-	profile = p_key.get()
+	profile = repo.get(p_key)
 	
 	# Create new Profile if it does not exist already
 	if not profile:
@@ -843,12 +2055,12 @@ class ConferenceApi(remote.Service):
 	                mainEmail= user.email(),
 	                teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
 	            )
-	    profile.put()
+	    repo.put(profile)
 
         # Get websafesession key from request and raise hell if it does not resolve to a valid session       
         ses_key = request.websafeSessionKey      
         try:
-            sess = ndb.Key(urlsafe=ses_key).get() 
+            sess = repo.get(ndb.Key(urlsafe=ses_key))
         except:
             raise endpoints.BadRequestException('No session found with key: %s' % ses_key)
         
@@ -857,12 +2069,15 @@ class ConferenceApi(remote.Service):
         if ses_key not in profile.SessionsInWishlist:
             raise ConflictException( "This Session is not in WishList. Nothing to delete!")
 
-        # Delete from WishList
-        profile.SessionsInWishlist.remove(ses_key)
+        # Delete from WishList; a rebuild of the slots may already have
+        # dropped it, if the session was deleted
+        self._wishlistSlots(profile).remove(ses_key)
+        if ses_key in profile.SessionsInWishlist:
+            profile.SessionsInWishlist.remove(ses_key)
         retval = True
 
         # Write to Profile datastore & return
-        profile.put()
+        repo.put(profile)
         return BooleanMessage(data=True)
 
 
@@ -889,7 +2104,7 @@ class ConferenceApi(remote.Service):
         # Get profile of user from Profile datastore
 	user_id = getUserId(user)
 	p_key = ndb.Key(Profile, user_id)
-	profile = p_key.get()
+	profile = repo.get(p_key)
 	
 	# Create new Profile if it does not exist already
 	if not profile:
@@ -899,17 +2114,35 @@ class ConferenceApi(remote.Service):
 	                mainEmail= user.email(),
 	                teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
 	            )
-	    profile.put()
+	    repo.put(profile)
         
         sess_keys = [ndb.Key(urlsafe=ses) for ses in profile.SessionsInWishlist]
-        sessions = ndb.get_multi(sess_keys)
+        sessions = repo.getMulti(sess_keys)
 
-        # return set of SessionForm objects per Session
+        # return set of SessionForm objects per Session, skipping sessions
+        # that no longer exist
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
+            items=[self._copySessionToForm(sess) for sess in sessions if sess]
         )
         
         
+    @endpoints.method(message_types.VoidMessage, WishlistConflictForms,
+            path='sessions/wishlist/conflicts',
+            http_method='GET', name='getWishlistConflicts')
+    def getWishlistConflicts(self, request):
+        """Return every pair of wishlist sessions whose time slots overlap."""
+        profile = self._getProfileFromUser()
+        stale = self._wishlistSlotsStale(profile)
+        wishlist = list(profile.SessionsInWishlist)
+        slots = self._wishlistSlots(profile)
+        if stale:
+            self._saveWishlistSlots(profile, wishlist)
+        return WishlistConflictForms(
+            items=[WishlistConflictForm(websafeSessionKey=first, conflictingSessionKey=second)
+                   for first, second in slots.conflicts()]
+        )
+
+        
 #############  TASK 3 ::  All non-workshop sessions before 7 pm   ################
     @endpoints.method(message_types.VoidMessage, SessionForms,
             path='sessions/before7filter',
@@ -918,7 +2151,7 @@ class ConferenceApi(remote.Service):
         """Return all non-workshop sessions before 7 pm"""
 
         # First get all non-workshop sessions
-        q = Session.query()
+        q = repo.query(Session)
         q = q.filter(Session.typeOfSession!='WORKSHOP')
 
         # Loop over Sessions returned above to return only 
@@ -944,7 +2177,7 @@ class ConferenceApi(remote.Service):
         """Get the Total Number of Sessions"""
 
         # Query sessions and get the SUM
-        qCount = Session.query().count()
+        qCount = repo.query(Session).count()
         #logging.debug("getTotalNumberOfSessions :: Count is %d", qCount)
 
         # Return SessionForm object
@@ -959,7 +2192,7 @@ class ConferenceApi(remote.Service):
         """Get a list of Keynote speakers"""
 
         # Get all sessions of type KEYNOTE
-        q = Session.query().filter(Session.typeOfSession=='KEYNOTE')
+        q = repo.query(Session).filter(Session.typeOfSession=='KEYNOTE')
 
         # Assign all returned speakers to a speaker array
         speaker_arr = []
@@ -973,48 +2206,415 @@ class ConferenceApi(remote.Service):
         # return String of comma separated speakers
         return StringMessage(data=speaker_list or "")
 
+############# Top speakers across conferences  #############
+
+    @staticmethod
+    def _queueSpeakerRecount(speaker):
+        """Queue one recount of a speaker's counters per debounce window;
+        call after sessions by speaker are written or deleted.
+        """
+        ConferenceApi._addDebouncedTask(
+            'recount-speaker-%s' % hashlib.sha1(speaker.encode('utf-8')).hexdigest(),
+            '/tasks/recount_speaker', {'speaker': speaker},
+            SPEAKER_RECOUNT_DEBOUNCE_SECONDS)
+
+
+    @staticmethod
+    def _recountSpeaker(speaker):
+        """Recount a speaker's counters from their sessions & queue a
+        leaderboard refresh.
+
+        Counting from scratch, in one debounced task per speaker, keeps
+        popular speakers' counters out of session writes, and retries or
+        deletions can't make them drift; the debounce window also covers
+        the lag of the speaker query behind those writes.
+        """
+        counter = SpeakerCounter(id=speaker)
+        typeCounts = {}
+        monthCounts = {}
+        for sess in repo.query(Session, Session.speaker == speaker).iter(batchSize=500):
+            counter.sessionCount += 1
+            typeCounts[sess.typeOfSession] = typeCounts.get(sess.typeOfSession, 0) + 1
+            if sess.sessionDate:
+                month = str(sess.sessionDate.month)
+                monthCounts[month] = monthCounts.get(month, 0) + 1
+        counter.typeCounts = typeCounts
+        counter.monthCounts = monthCounts
+        if counter.sessionCount:
+            repo.put(counter)
+        else:
+            repo.delete(counter.key)
+        ConferenceApi._queueSpeakerLeaderboard()
+
+
+    @staticmethod
+    def _queueSpeakerLeaderboard():
+        """Queue one leaderboard refresh per debounce window."""
+        ConferenceApi._addDebouncedTask('speaker-leaderboard',
+            '/tasks/refresh_speaker_leaderboard', {},
+            SPEAKER_LEADERBOARD_DEBOUNCE_SECONDS)
+
+
+    @staticmethod
+    def _refreshSpeakerLeaderboard():
+        """Rank speakers from their counters, overall, per session type
+        and per month, keeping one bounded min-heap per ranking.
+        """
+        heaps = {}
+        def push(ranking, speaker, count):
+            if count <= 0:
+                return
+            heap = heaps.setdefault(ranking, [])
+            if len(heap) < SPEAKER_LEADERBOARD_SIZE:
+                heapq.heappush(heap, (count, speaker))
+            elif (count, speaker) > heap[0]:
+                heapq.heapreplace(heap, (count, speaker))
+
+        for counter in repo.query(SpeakerCounter).iter(batchSize=500):
+            speaker = counter.key.id()
+            push('', speaker, counter.sessionCount)
+            for typeOfSession, count in (counter.typeCounts or {}).items():
+                push('type:' + typeOfSession, speaker, count)
+            for month, count in (counter.monthCounts or {}).items():
+                push('month:' + month, speaker, count)
+
+        rankings = dict(
+            (ranking, [[speaker, count] for count, speaker in
+                       sorted(heap, key=lambda entry: (-entry[0], entry[1]))])
+            for ranking, heap in heaps.items())
+        board = SpeakerLeaderboard(id=SPEAKER_LEADERBOARD_ID, rankings=rankings)
+        repo.put(board)
+        l1.set(MEMCACHE_SPEAKER_LEADERBOARD_KEY, board, SPEAKER_LEADERBOARD_NAMESPACE)
+        return board
+
+
+    @endpoints.method(TOP_SPEAKERS_GET_REQUEST, TopSpeakersForm,
+            path='speakers/top',
+            http_method='GET', name='getTopSpeakers')
+    def getTopSpeakers(self, request):
+        """Return the speakers with the most sessions across conferences, optionally of one typeOfSession or in one month (1-12)."""
+        limit = min(request.limit or TOP_SPEAKERS_DEFAULT, SPEAKER_LEADERBOARD_SIZE)
+        if request.typeOfSession and request.month:
+            raise endpoints.BadRequestException('Filter by typeOfSession or by month, not both')
+        ranking = ''
+        if request.typeOfSession:
+            if request.typeOfSession not in SessionType.names():
+                raise endpoints.BadRequestException('Unknown typeOfSession: %s' % request.typeOfSession)
+            ranking = 'type:' + request.typeOfSession
+        elif request.month:
+            if not 1 <= request.month <= 12:
+                raise endpoints.BadRequestException('month must be between 1 and 12')
+            ranking = 'month:%d' % request.month
+
+        board = l1.get(MEMCACHE_SPEAKER_LEADERBOARD_KEY, SPEAKER_LEADERBOARD_NAMESPACE,
+                       lambda: repo.get(ndb.Key(SpeakerLeaderboard, SPEAKER_LEADERBOARD_ID)))
+        if not board:
+            # never computed; the next request after the task runs gets it
+            self._queueSpeakerLeaderboard()
+            return TopSpeakersForm(items=[])
+        return TopSpeakersForm(
+            items=[CountForm(name=speaker, count=count) for speaker, count in
+                   (board.rankings or {}).get(ranking, [])[:limit]],
+            refreshed=str(board.refreshed)
+        )
+
+############# Conference & session deletion  #############
+
+    @staticmethod
+    @transactional(xg=True)
+    def _deleteConferenceObject(conf_key):
+        """Delete a conference & its dashboard, and record the cascade that
+        deletes its sessions; returns False if there is no such conference.
+        """
+        if not repo.get(conf_key):
+            return False
+        repo.deleteMulti([conf_key, ConferenceApi._dashboardKey(conf_key)])
+        repo.put(ConferenceDeletion(id=conf_key.urlsafe()))
+        return True
+
+
+    @staticmethod
+    @transactional()
+    def _deleteSessions(keys):
+        """Delete sessions, all of one conference, and take them off its
+        dashboard; returns the sessions deleted. Sessions already gone are
+        skipped, so a retry counts each session once.
+        """
+        sessions = [sess for sess in repo.getMulti(keys) if sess]
+        if sessions:
+            repo.deleteMulti([sess.key for sess in sessions])
+            ConferenceApi._adjustDashboard(sessions[0].key.parent(), sessions=sessions, delta=-1)
+        return sessions
+
+
+    @staticmethod
+    def _deleteConferenceSessions(wsck):
+        """Delete a batch of a deleted conference's sessions, checkpoint,
+        and queue the next batch.
+
+        Each batch queries from the start again, as the sessions before it
+        are gone; finishing also drops the conference's waitlist. Does
+        nothing unless the conference is gone & its cascade is running.
+        """
+        conf_key = ndb.Key(urlsafe=wsck)
+        checkpoint = repo.get(ndb.Key(ConferenceDeletion, wsck))
+        if not (checkpoint and checkpoint.running) or repo.get(conf_key):
+            logging.warning('No running deletion of conference %s', wsck)
+            return
+        keys = repo.query(Session, ancestor=conf_key).fetch(
+            CONFERENCE_DELETE_BATCH, keysOnly=True)
+        sessions = ConferenceApi._deleteSessions(keys)
+        deleted = len(sessions)
+        for speaker in set(sess.speaker for sess in sessions):
+            ConferenceApi._queueSpeakerRecount(speaker)
+
+        checkpoint = ConferenceApi._checkpointConferenceDeletion(
+            wsck, deleted, len(keys) == CONFERENCE_DELETE_BATCH)
+        if checkpoint.running:
+            ConferenceApi._queueSessionDeletion(wsck, checkpoint.sessionsDeleted)
+        else:
+            repo.deleteMulti(repo.query(WaitlistEntry,
+                WaitlistEntry.websafeConferenceKey == wsck).fetch(keysOnly=True))
+        ConferenceApi._invalidateSessionIndex(wsck)
+
+
+    @staticmethod
+    @transactional()
+    def _checkpointConferenceDeletion(wsck, deleted, running):
+        """Add deleted to a cascade's count of deleted sessions and record
+        whether it is still running; returns the checkpoint.
+        """
+        checkpoint = repo.get(ndb.Key(ConferenceDeletion, wsck)) or ConferenceDeletion(id=wsck)
+        checkpoint.sessionsDeleted += deleted
+        checkpoint.running = running
+        repo.put(checkpoint)
+        return checkpoint
+
+
+    @staticmethod
+    def _queueSessionDeletion(wsck, sessionsDeleted):
+        """Queue the next batch of a cascade, named after its checkpoint, so
+        a resumed cascade and its own chain don't run the batch twice.
+        """
+        try:
+            taskqueue.add(name='delete-sessions-%s-%d' % (wsck, sessionsDeleted),
+                          params={'websafeConferenceKey': wsck},
+                          url='/tasks/delete_conference_sessions')
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+
+    @staticmethod
+    def _resumeConferenceDeletions():
+        """Queue again the cascades whose checkpoint has not moved for a
+        while; returns how many.
+        """
+        stale = datetime.utcnow() - timedelta(seconds=CONFERENCE_DELETE_STALE_SECONDS)
+        resumed = 0
+        for checkpoint in repo.query(ConferenceDeletion, ConferenceDeletion.running == True):
+            if checkpoint.updated < stale:
+                ConferenceApi._queueSessionDeletion(checkpoint.key.id(), checkpoint.sessionsDeleted)
+                resumed += 1
+        return resumed
+
+
+    @endpoints.method(SESSION_GET_REQUEST, BooleanMessage,
+            path='session/delete/{websafeSessionKey}',
+            http_method='DELETE', name='deleteSession')
+    def deleteSession(self, request):
+        """Delete a session; only the organizer of its conference can."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        wssk = request.websafeSessionKey
+        try:
+            s_key = ndb.Key(urlsafe=wssk)
+        except:
+            raise endpoints.BadRequestException('Session not found for key: %s' % wssk)
+        if s_key.kind() != 'Session' or s_key.parent() is None or s_key.parent().parent() is None:
+            raise endpoints.BadRequestException('Session not found for key: %s' % wssk)
+        # the session's conference key's parent is its organizer's Profile
+        if s_key.parent().parent().id() != getUserId(user):
+            raise endpoints.ForbiddenException(
+                'Only the owner of the conference can delete its sessions.')
+        sessions = self._deleteSessions([s_key])
+        if not sessions:
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % wssk)
+
+        # wishlists keep the key until the dangling reference sweeper runs
+        wsck = s_key.parent().urlsafe()
+        self._invalidateSessionIndex(wsck)
+        self._queueFeaturedSpeaker(wsck)
+        self._queueSpeakerRecount(sessions[0].speaker)
+        return BooleanMessage(data=True)
+
+############# Session search across conferences  #############
+
+    @staticmethod
+    def _copyConferenceFields(conf, session):
+        """Copy the conference fields that sessions are searched by onto a session."""
+        session.conferenceCity = conf.city
+        session.conferenceMonth = conf.month
+        session.conferenceTopics = list(conf.topics or [])
+
+
+    @staticmethod
+    def _queueCopyConferenceFields(wsck):
+        """Queue one copy of a conference's fields to its sessions per
+        debounce window."""
+        ConferenceApi._addDebouncedTask('copy-conference-fields-%s' % wsck,
+            '/tasks/copy_conference_fields', {'websafeConferenceKey': wsck},
+            SESSION_COPY_DEBOUNCE_SECONDS)
+
+
+    @staticmethod
+    def _copyConferenceFieldsPage(wsck=None, cursor=None):
+        """Copy conference fields onto one page of the sessions of wsck, or
+        of every conference, and queue the next page; sessions already up
+        to date are not written.
+        """
+        if wsck:
+            q = repo.query(Session, ancestor=ndb.Key(urlsafe=wsck))
+        else:
+            q = repo.query(Session)
+        keys, nextCursor = q.fetchPage(SESSION_COPY_BATCH, cursor, keysOnly=True)
+        byConference = {}
+        for key in keys:
+            byConference.setdefault(key.parent(), []).append(key)
+        for conf_key, sess_keys in byConference.items():
+            ConferenceApi._copyConferenceFieldsToSessions(conf_key, sess_keys)
+        if nextCursor:
+            taskqueue.add(params={'websafeConferenceKey': wsck or '', 'cursor': nextCursor},
+                          url='/tasks/copy_conference_fields')
+
+
+    @staticmethod
+    @transactional()
+    def _copyConferenceFieldsToSessions(conf_key, keys):
+        """Copy conference fields onto sessions of that conference, read
+        again in the transaction; sessions or a conference deleted since
+        the page was read are skipped, not written back.
+        """
+        entities = repo.getMulti([conf_key] + keys)
+        conf, sessions = entities[0], [sess for sess in entities[1:] if sess]
+        if conf:
+            for sess in sessions:
+                ConferenceApi._copyConferenceFields(conf, sess)
+            putChanged(sessions)
+
+
+    @endpoints.method(SESSION_SEARCH_GET_REQUEST, SessionPageForm,
+            path='sessions/search',
+            http_method='GET', name='searchSessions')
+    def searchSessions(self, request):
+        """Return a page of sessions across conferences by typeOfSession and the conference's city, month (1-12) and topic; at least one is required.
+
+        Pass nextCursor back, with the same filters, for the next page.
+        """
+        # equality filters only, served by merging the built-in
+        # single-property indexes, so no composite index is needed
+        filters = []
+        if request.typeOfSession:
+            if request.typeOfSession not in SessionType.names():
+                raise endpoints.BadRequestException('Unknown typeOfSession: %s' % request.typeOfSession)
+            filters.append(Session.typeOfSession == request.typeOfSession)
+        if request.city:
+            filters.append(Session.conferenceCity == request.city)
+        if request.month:
+            if not 1 <= request.month <= 12:
+                raise endpoints.BadRequestException('month must be between 1 and 12')
+            filters.append(Session.conferenceMonth == request.month)
+        if request.topic:
+            filters.append(Session.conferenceTopics == request.topic)
+        if not filters:
+            raise endpoints.BadRequestException('Search by typeOfSession, city, month or topic')
+        pageSize = min(request.pageSize or SESSION_SEARCH_PAGE_SIZE, SESSION_SEARCH_MAX_PAGE_SIZE)
+
+        try:
+            sessions, nextCursor = repo.query(Session, *filters).fetchPage(pageSize, request.cursor)
+        except BadCursorError:
+            raise endpoints.BadRequestException('Invalid cursor')
+        return SessionPageForm(
+            items=[self._copySessionToForm(sess) for sess in sessions],
+            nextCursor=nextCursor
+        )
+
 ##################### TASK 4 :: The function that the featuredSpeaker Task would call #############
+    @staticmethod
+    def _addDebouncedTask(name, url, params, window, delay=0):
+        """Add a task at most once per time bucket of window seconds.
+
+        The task is named after name and the bucket, so every add in the
+        bucket maps onto the same task, which runs delay seconds after the
+        bucket has closed.
+        """
+        now = calendar.timegm(datetime.utcnow().utctimetuple())
+        bucket = now // window
+        try:
+            taskqueue.add(
+                name='%s-%d' % (name, bucket),
+                countdown=(bucket + 1) * window - now + delay,
+                params=params,
+                url=url
+                )
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # already queued for this window
+            pass
+
+
+    @staticmethod
+    def _queueFeaturedSpeaker(websafeConferenceKey):
+        """Queue one featured speaker task per conference per debounce window."""
+        ConferenceApi._addDebouncedTask('featured-speaker-%s' % websafeConferenceKey,
+            '/tasks/cache_featured_speaker',
+            {'websafeConferenceKey': websafeConferenceKey},
+            FEATURED_SPEAKER_DEBOUNCE_SECONDS)
+
+
     @staticmethod
     def _cacheFeaturedSpeaker(self):
         """Add featured speaker to memcache.
+
+        The featured speaker is the speaker with the most sessions in the
+        conference, provided they speak in more than one.
         """     
-        #logging.debug("_cacheFeaturedSpeaker ::  Begin")
-        
-        speaker = self.request.get('speaker')
         confkey = self.request.get('websafeConferenceKey')
         
-        #logging.debug("_cacheFeaturedSpeaker ::  speaker is %s", speaker)
         #logging.debug("_cacheFeaturedSpeaker ::  websafeconference key is %s", confkey)
 
-        # get conference from websafeconference key in a try catch block
+        # create ancestor query for all session entities of the given conference
         try:
-            conf = ndb.Key(urlsafe=confkey).get() 
+            q = repo.query(Session, ancestor=ndb.Key(urlsafe=confkey))
         except:
-            raise endpoints.BadRequestException('No conference found with key: %s' % request.websafeConferenceKey)
-        
-        # create ancestor query for all session entities of the given conference
-        q = Session.query(ancestor=ndb.Key(urlsafe=confkey))
+            raise endpoints.BadRequestException('No conference found with key: %s' % confkey)
  
-        # Get Count of sessions in which speaker speaks
-        speakerCount = q.filter(Session.speaker == speaker).count()
+        # Group session names by speaker in a single pass over the conference
+        speakerSessions = {}
+        for sess in q:
+            speakerSessions.setdefault(sess.speaker, []).append(sess.sessionName)
+        if not speakerSessions:
+            return
+        speaker, sessionNames = max(speakerSessions.items(), key=lambda item: len(item[1]))
      
-        #logging.debug("_cacheFeaturedSpeaker ::  speakerCount is %s", speakerCount)
-        
         # If speaker is a featured speaker add the Announcement to MEMCACHE    
         # making sure that Session Names are added as well to the announcement.
      
-        if speakerCount > 1:
+        if len(sessionNames) > 1:
             #logging.debug("_cacheFeaturedSpeaker :: Adding speaker %s to memcache ", str(speaker) )
-            sessionList = ', '.join(sess.sessionName for sess in q)
+            sessionList = ', '.join(sessionNames)
             Announcement = FEATURED_SPEAKER_ANNOUNCEMENT_TPL % ( str(speaker) , sessionList)
-            memcache.set(MEMCACHE_SPEAKER_KEY, Announcement)
+            l1.set(MEMCACHE_SPEAKER_KEY, Announcement, SPEAKER_NAMESPACE)
 
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='featuredSpeaker/get',
             http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
-        """Return Featured Speaker from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_SPEAKER_KEY) or "")
+        """Return Featured Speaker from the instance cache or memcache."""
+        return StringMessage(data=l1.get(MEMCACHE_SPEAKER_KEY, SPEAKER_NAMESPACE) or "")
+
+# most viewed conferences, preloaded by the warmup handler
+hotConferences = HotKeys(HOT_CONFERENCES_KEY)
 
-api = endpoints.api_server([ConferenceApi]) # register API
\ No newline at end of file
+api = profiled(endpoints.api_server([ConferenceApi])) # register API
\ No newline at end of file
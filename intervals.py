@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""intervals.py
+
+Conference Central sorted interval structures for session time slots
+
+Times are whole minutes since the epoch (see toMinutes), and every
+interval is half-open: [start, end).
+
+"""
+
+import calendar
+from bisect import bisect_left
+from bisect import bisect_right
+from datetime import datetime
+
+
+def toMinutes(day, start):
+    """Minutes since the epoch for a date and a time of day."""
+    return calendar.timegm(datetime.combine(day, start).timetuple()) // 60
+
+
+def sessionInterval(session):
+    """(start, end) of a Session; a missing duration counts as one minute."""
+    start = toMinutes(session.sessionDate, session.startTime)
+    return (start, start + max(session.duration or 0, 1))
+
+
+class SortedIntervals(object):
+    """Intervals with payloads kept as parallel lists sorted by start.
+
+    The lists are used in place, so they can be repeated properties of an
+    entity. maxLength bounds the longest interval; overlap lookups bisect
+    on start times from (start - maxLength), touching only intervals near
+    the window.
+    """
+
+    def __init__(self, starts, ends, payloads, maxLength=None):
+        self.starts = starts
+        self.ends = ends
+        self.payloads = payloads
+        if maxLength is None:
+            maxLength = max([e - s for s, e in zip(starts, ends)] or [0])
+        self.maxLength = maxLength
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _overlappingIndexes(self, start, end):
+        lo = bisect_right(self.starts, start - self.maxLength)
+        hi = bisect_left(self.starts, end)
+        return [i for i in xrange(lo, hi) if self.ends[i] > start]
+
+    def overlapping(self, start, end):
+        """Payloads of intervals overlapping [start, end), by start time."""
+        return [self.payloads[i] for i in self._overlappingIndexes(start, end)]
+
+    def at(self, minute):
+        """Payloads of intervals running at minute."""
+        return self.overlapping(minute, minute + 1)
+
+    def startingAfter(self, minute):
+        """Payloads of the intervals with the earliest start after minute."""
+        i = bisect_right(self.starts, minute)
+        if i == len(self.starts):
+            return []
+        j = bisect_right(self.starts, self.starts[i])
+        return self.payloads[i:j]
+
+    def add(self, start, end, payload):
+        """Insert an interval, keeping the lists sorted."""
+        i = bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.payloads.insert(i, payload)
+        self.maxLength = max(self.maxLength, end - start)
+
+    def remove(self, payload):
+        """Remove the interval carrying payload, if any; maxLength stays
+        an upper bound.
+        """
+        if payload in self.payloads:
+            i = self.payloads.index(payload)
+            del self.starts[i], self.ends[i], self.payloads[i]
+
+    def conflicts(self):
+        """All pairs of payloads whose intervals overlap."""
+        pairs = []
+        for i in xrange(len(self.starts)):
+            j = i + 1
+            while j < len(self.starts) and self.starts[j] < self.ends[i]:
+                pairs.append((self.payloads[i], self.payloads[j]))
+                j += 1
+        return pairs
+
+
+class IntervalIndex(SortedIntervals):
+    """Immutable SortedIntervals built from unsorted items."""
+
+    def __init__(self, items):
+        """items -- iterable of (start, end, payload)"""
+        items = sorted(items, key=lambda item: (item[0], item[1]))
+        SortedIntervals.__init__(self,
+            [item[0] for item in items],
+            [item[1] for item in items],
+            [item[2] for item in items])
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+"""loadtest.py
+
+Conference Central in-process load generator
+
+Drives main.app and the endpoints API (conference.api) through WSGI
+against App Engine testbed stubs, from a pool of worker threads, and
+reports throughput, latency percentiles, datastore commit collisions
+(transaction retries) and error rates per API method. Queued push
+tasks are run by a background thread once their ETA has passed, so
+contention from task handlers is included. With --storage sqlite[:path]
+entities live in SQLite instead of the datastore stub (see
+repository.py); commit collisions are then always zero.
+
+usage: python loadtest.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+           [--scenario registration_storm|upload_while_browsing|wishlist_burst|all]
+           [--workers 20] [--requests 50] [--storage ndb|sqlite[:path]]
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def fixSysPath(sdk):
+    """Put the App Engine SDK and its bundled libraries on sys.path."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+# - - - Stats - - - - - - - - - - - - - - - - - - - - - - - -
+
+class Stats(object):
+    """Thread-safe latency, status & commit counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)     # method -> [seconds]
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.commits = 0
+        self.collisions = 0
+        self.started = time.time()
+
+    def record(self, method, status, seconds):
+        with self._lock:
+            self.latencies[method].append(seconds)
+            self.statuses[method][status] += 1
+
+    def commitHook(self, service, call, request, response, rpc=None, error=None):
+        """apiproxy post-call hook counting datastore commits; a failed
+        commit is a transaction collision that ndb retries.
+        """
+        if call == 'Commit':
+            with self._lock:
+                self.commits += 1
+                if error is not None:
+                    self.collisions += 1
+
+    def report(self, title):
+        elapsed = time.time() - self.started
+        total = sum(len(l) for l in self.latencies.values())
+        print '\n== %s: %d requests in %.1fs (%.1f req/s)' % (
+            title, total, elapsed, total / elapsed if elapsed else 0)
+        print '   datastore commits %d, collisions %d (%.1f%%)' % (
+            self.commits, self.collisions,
+            100.0 * self.collisions / self.commits if self.commits else 0)
+        print '   %-40s %6s %8s %8s %8s %8s %7s' % (
+            'method', 'count', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'err %')
+        for method in sorted(self.latencies):
+            lat = sorted(self.latencies[method])
+            errors = sum(n for status, n in self.statuses[method].items() if status >= 500)
+            print '   %-40s %6d %8.1f %8.1f %8.1f %8.1f %7.1f' % (
+                method, len(lat), len(lat) / elapsed,
+                _percentile(lat, 50), _percentile(lat, 90), _percentile(lat, 99),
+                100.0 * errors / len(lat))
+            other = dict((s, n) for s, n in self.statuses[method].items()
+                         if s >= 300 and s < 500)
+            if other:
+                print '   %-40s statuses %s' % ('', other)
+
+
+def _percentile(sorted_values, pct):
+    """Nearest-rank percentile, in milliseconds."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, int(round(pct / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[rank] * 1000
+
+# - - - Harness - - - - - - - - - - - - - - - - - - - - - - -
+
+class Harness(object):
+    """Testbed stubs plus WSGI drivers for the API, tasks & crons."""
+
+    def __init__(self, stats, verbose=False):
+        from google.appengine.api import apiproxy_stub_map
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+        import endpoints
+
+        self.stats = stats
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # endpoints reads the app revision from a dotted version id
+        self.testbed.setup_env(current_version_id='loadtest.1', overwrite=True)
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1),
+            require_indexes=False)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_urlfetch_stub()
+        self.testbed.init_user_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'loadtest_commits', stats.commitHook, 'datastore_v3')
+
+        # each worker thread acts as its own signed-in user
+        self._local = threading.local()
+        endpoints.get_current_user = lambda: getattr(self._local, 'user', None)
+
+        import conference
+        import main
+        # errors are counted in the report; the app's own logging is noise
+        logging.getLogger().setLevel(logging.DEBUG if verbose else logging.CRITICAL)
+        self.api = conference.api
+        self.app = main.app
+        self._stop = threading.Event()
+        self._taskLock = threading.Lock()
+
+    def call(self, method, user=None, **body):
+        """POST to an API method over the SPI path; return (status, json)."""
+        from google.appengine.api import users
+        from google.appengine.ext import ndb
+        import webob
+
+        self._local.user = users.User(user) if user else None
+        ndb.set_context(ndb.make_default_context())     # fresh per request
+        req = webob.Request.blank('/_ah/spi/ConferenceApi.%s' % method,
+            method='POST', body=json.dumps(body),
+            # as sent by the Endpoints frontend, which the SPI requires
+            headers={'Content-Type': 'application/json',
+                     'X-AppEngine-Peer': 'apiserving'})
+        start = time.time()
+        resp = req.get_response(self.api)
+        self.stats.record(method, resp.status_int, time.time() - start)
+        try:
+            return resp.status_int, json.loads(resp.body or '{}')
+        except ValueError:
+            return resp.status_int, {}
+
+    def runTasks(self, ignore_eta=False):
+        """Run due push tasks through main.app; return how many ran."""
+        from google.appengine.ext import ndb
+        import webob
+
+        ran = 0
+        with self._taskLock:
+            for task in self.taskqueue.get_filtered_tasks(queue_names=['default']):
+                if not ignore_eta and task.eta_posix > time.time():
+                    continue
+                self.taskqueue.DeleteTask('default', task.name)
+                ndb.set_context(ndb.make_default_context())
+                req = webob.Request.blank(task.url, method='POST', body=task.payload,
+                    headers=dict(task.headers))
+                start = time.time()
+                resp = req.get_response(self.app)
+                self.stats.record('task ' + task.url, resp.status_int, time.time() - start)
+                ran += 1
+        return ran
+
+    def runCron(self, url):
+        import webob
+        start = time.time()
+        resp = webob.Request.blank(url).get_response(self.app)
+        self.stats.record('cron ' + url, resp.status_int, time.time() - start)
+
+    def startTaskRunner(self, interval=0.2):
+        def loop():
+            while not self._stop.is_set():
+                self.runTasks()
+                self._stop.wait(interval)
+        runner = threading.Thread(target=loop)
+        runner.daemon = True
+        runner.start()
+        return runner
+
+    def finish(self):
+        """Stop the task runner & drain everything still queued."""
+        self._stop.set()
+        while self.runTasks(ignore_eta=True):
+            pass
+        self.runCron('/crons/send_confirmation_emails')
+        self.testbed.deactivate()
+
+
+def runWorkers(workers, target):
+    """Run target(worker_index) on each of workers threads & wait."""
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def createConference(h, organizer, seats, sessions=0):
+    """Create a conference (and sessions) as organizer; return its key."""
+    h.call('getProfile', organizer)     # as the web client does on sign-in
+    h.call('createConference', organizer, name='Load test conference',
+           city='London', topics=['Load'], startDate='2016-06-01',
+           endDate='2016-06-03', maxAttendees=seats)
+    _, created = h.call('getConferencesCreated', organizer)
+    wsck = created['items'][-1]['websafeKey']
+    for i in range(sessions):
+        createSession(h, organizer, wsck, i)
+    return wsck
+
+
+def createSession(h, organizer, wsck, i):
+    return h.call('createSession', organizer, websafeConferenceKey=wsck,
+        sessionName='Session %d' % i, speaker='Speaker %d' % (i % 7),
+        typeOfSession=['LECTURE', 'KEYNOTE', 'WORKSHOP'][i % 3],
+        sessionDate='2016-06-0%d' % (1 + i % 3),
+        startTime=900 + 100 * (i % 8), duration=50)
+
+# - - - Scenarios - - - - - - - - - - - - - - - - - - - - - -
+
+def registrationStorm(h, workers, requests):
+    """Every worker registers distinct users for one conference with
+    fewer seats than users, then some unregister to free seats.
+    """
+    wsck = createConference(h, 'organizer@example.com', seats=workers * requests / 2)
+
+    def worker(w):
+        for i in range(requests):
+            user = 'user-%d-%d@example.com' % (w, i)
+            h.call('registerForConference', user, websafeConferenceKey=wsck)
+            if i % 5 == 0:
+                h.call('unregisterFromConference', user, websafeConferenceKey=wsck)
+    runWorkers(workers, worker)
+
+
+def asyncRegistrationStorm(h, workers, requests):
+    """As registrationStorm, through requestRegistration & ticket polling."""
+    wsck = createConference(h, 'organizer@example.com', seats=workers * requests / 2)
+
+    def worker(w):
+        for i in range(requests):
+            user = 'user-%d-%d@example.com' % (w, i)
+            status, ticket = h.call('requestRegistration', user, websafeConferenceKey=wsck)
+            if status == 200:
+                h.call('getRegistrationTicket', user, ticket=ticket['ticket'])
+    runWorkers(workers, worker)
+
+
+def uploadWhileBrowsing(h, workers, requests):
+    """One organizer uploads sessions while the other workers browse the
+    conference, its agenda and time windows.
+    """
+    organizer = 'organizer@example.com'
+    wsck = createConference(h, organizer, seats=1000)
+
+    def worker(w):
+        user = 'attendee-%d@example.com' % w
+        for i in range(requests):
+            if w == 0:
+                createSession(h, organizer, wsck, i)
+            elif i % 4 == 0:
+                h.call('getConference', user, websafeConferenceKey=wsck)
+            elif i % 4 == 1:
+                h.call('getConferenceSessions', user, websafeConferenceKey=wsck)
+            elif i % 4 == 2:
+                h.call('getConferenceAgenda', user, websafeConferenceKey=wsck)
+            else:
+                h.call('getSessionsInTimeWindow', user, websafeConferenceKey=wsck,
+                       sessionDate='2016-06-01', startTime=1000, endTime=1400)
+    runWorkers(workers, worker)
+
+
+def wishlistBurst(h, workers, requests):
+    """Attendees add sessions to their wishlists and re-sync them."""
+    wsck = createConference(h, 'organizer@example.com', seats=1000, sessions=24)
+    _, sessions = h.call('getConferenceSessions', None, websafeConferenceKey=wsck)
+    keys = [s['websafeKey'] for s in sessions.get('items', [])]
+
+    def worker(w):
+        user = 'attendee-%d@example.com' % w
+        for i in range(requests):
+            h.call('addSessionToWishlist', user, websafeSessionKey=keys[(w + i) % len(keys)])
+            h.call('getSessionsInWishlist', user)
+            if i % 3 == 0:
+                h.call('getWishlistConflicts', user)
+    runWorkers(workers, worker)
+
+
+SCENARIOS = [
+    ('registration_storm', registrationStorm),
+    ('async_registration_storm', asyncRegistrationStorm),
+    ('upload_while_browsing', uploadWhileBrowsing),
+    ('wishlist_burst', wishlistBurst),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine Python SDK (google_appengine)')
+    parser.add_argument('--scenario', default='all',
+                        choices=[name for name, _ in SCENARIOS] + ['all'])
+    parser.add_argument('--workers', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=50,
+                        help='iterations per worker')
+    parser.add_argument('--verbose', action='store_true',
+                        help="keep the app's logging")
+    parser.add_argument('--storage', default=os.environ.get('CONFERENCE_STORAGE', 'ndb'),
+                        help='ndb, or sqlite with an optional :path (in memory without)')
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('--sdk or APPENGINE_SDK is required')
+    fixSysPath(args.sdk)
+    # read by repository.py when the app is first imported
+    os.environ['CONFERENCE_STORAGE'] = args.storage
+
+    for name, scenario in SCENARIOS:
+        if args.scenario not in ('all', name):
+            continue
+        stats = Stats()
+        harness = Harness(stats, args.verbose)
+        harness.startTaskRunner()
+        scenario(harness, args.workers, args.requests)
+        harness.finish()
+        stats.report(name)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,10 +12,65 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import time
+IMPORT_STARTED = time.time()    # instance startup, timed by the warmup handler
+
+import json
+import logging
+import pstats
+import re
+import uuid
+
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.api import users
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+from conference import CONFIRMATION_EMAIL_QUEUE
+from conference import MEMCACHE_SPEAKER_KEY
+from conference import SPEAKER_NAMESPACE
+import bulk
+from cache import l1
+from profiling import profiled
+from profiling import profiler
+from repository import repo
+from repository import BadCursorError
+from utils import getUserId
+
+JOB_ID_RE = re.compile(r'^[a-zA-Z0-9_-]{1,100}$')
+EMAIL_LEASE_SECONDS = 120       # time to send one leased batch
+EMAIL_LEASE_BATCH = 500         # confirmation tasks leased at once
+EMAIL_RUN_SECONDS = 50          # stop leasing before the next cron run
+EMAIL_MAX_LEASES = 5            # sends tried per task before it is dropped
+WARMUP_CONFERENCES = 20         # most viewed conferences preloaded
+IMPORT_SECONDS = time.time() - IMPORT_STARTED
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Prime a new instance before it takes traffic & time its startup."""
+        # the API config is generated when conference.py is imported,
+        # so it is part of the import time
+        timings = {'imports': IMPORT_SECONDS}
+        start = time.time()
+        # read through, without bumping generations on every instance
+        ConferenceApi._primeAnnouncement()
+        l1.get(MEMCACHE_SPEAKER_KEY, SPEAKER_NAMESPACE)
+        timings['announcements'] = time.time() - start
+
+        start = time.time()
+        loaded = ConferenceApi._preloadConferences(WARMUP_CONFERENCES)
+        timings['conferences'] = time.time() - start
+        timings['total'] = time.time() - IMPORT_STARTED
+        logging.info('Warmup: %d conferences preloaded; seconds %s',
+                     loaded, json.dumps(timings, sort_keys=True))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'conferencesLoaded': loaded,
+            'seconds': timings,
+        }))
+
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -37,6 +92,51 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
                 'conferenceInfo')
         )
 
+
+class SendConfirmationEmailsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Lease queued confirmation emails & send one per recipient."""
+        queue = taskqueue.Queue(CONFIRMATION_EMAIL_QUEUE)
+        sender = 'noreply@%s.appspotmail.com' % app_identity.get_application_id()
+        stop_at = time.time() + EMAIL_RUN_SECONDS
+        while time.time() < stop_at:
+            tasks = queue.lease_tasks(EMAIL_LEASE_SECONDS, EMAIL_LEASE_BATCH)
+            if not tasks:
+                break
+
+            # group by recipient, dropping repeats of the same conference
+            recipients = {}
+            for task in tasks:
+                msg = json.loads(task.payload)
+                confs, done = recipients.setdefault(msg['email'], ({}, []))
+                confs.setdefault(msg['websafeConferenceKey'], msg['conferenceInfo'])
+                done.append(task)
+
+            # delete per recipient, so a failed send is retried on its own
+            # once its lease expires, and doesn't hold up the others
+            for email, (confs, done) in recipients.items():
+                try:
+                    mail.send_mail(
+                        sender,                                     # from
+                        email,                                      # to
+                        'You created a new Conference!',            # subj
+                        'Hi, you have created the following '       # body
+                        'conference(s):\r\n\r\n%s' % '\r\n\r\n'.join(
+                            confs.values())
+                    )
+                except Exception:
+                    logging.exception('Confirmation email to %s failed', email)
+                    done = [task for task in done if task.retry_count >= EMAIL_MAX_LEASES]
+                    if not done:
+                        continue
+                    logging.error('Giving up on %d confirmation emails to %s',
+                                  len(done), email)
+                queue.delete_tasks(done)
+
+            if len(tasks) < EMAIL_LEASE_BATCH:
+                break
+        self.response.set_status(204)
+
 class CacheFeaturedSpeakerHandler(webapp2.RequestHandler):
     def post(self):
         """Assign a speaker that speaks in more than one session to memcache"""      
@@ -44,8 +144,253 @@ class CacheFeaturedSpeakerHandler(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
-app = webapp2.WSGIApplication([
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+    def post(self):
+        """Register waitlisted users into freed seats, in batches."""
+        ConferenceApi._promoteWaitlist(self.request.get('websafeConferenceKey'))
+        self.response.set_status(204)
+
+
+class DrainRegistrationsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Apply queued registrations for a conference in batches."""
+        ConferenceApi._drainRegistrations(self.request.get('websafeConferenceKey'))
+        self.response.set_status(204)
+
+
+class StartProfileSweepHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start or resume the sweep of dangling Profile references."""
+        ConferenceApi._startProfileSweep()
+        self.response.set_status(204)
+
+
+class SweepProfilesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Sweep one page of Profiles & queue the next."""
+        ConferenceApi._sweepProfiles(self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class DeleteConferenceSessionsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Delete a batch of a deleted conference's sessions & queue the next."""
+        ConferenceApi._deleteConferenceSessions(self.request.get('websafeConferenceKey'))
+        self.response.set_status(204)
+
+
+class ResumeConferenceDeletionsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Restart conference deletion cascades that have stalled."""
+        ConferenceApi._resumeConferenceDeletions()
+        self.response.set_status(204)
+
+
+class RecountSpeakerHandler(webapp2.RequestHandler):
+    def post(self):
+        """Recount a speaker's session counters."""
+        ConferenceApi._recountSpeaker(self.request.get('speaker'))
+        self.response.set_status(204)
+
+
+class RebuildDashboardHandler(webapp2.RequestHandler):
+    def post(self):
+        """Recount a conference's organizer dashboard."""
+        ConferenceApi._rebuildDashboard(self.request.get('websafeConferenceKey'))
+        self.response.set_status(204)
+
+
+class RefreshSpeakerLeaderboardHandler(webapp2.RequestHandler):
+    def post(self):
+        """Re-rank the top speakers across conferences."""
+        ConferenceApi._refreshSpeakerLeaderboard()
+        self.response.set_status(204)
+
+
+class CopyConferenceFieldsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy conference fields onto one page of sessions & queue the next."""
+        ConferenceApi._copyConferenceFieldsPage(
+            self.request.get('websafeConferenceKey') or None,
+            self.request.get('cursor') or None)
+        self.response.set_status(204)
+
+
+class BackfillSessionFieldsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Start copying conference fields onto every session."""
+        taskqueue.add(url='/tasks/copy_conference_fields')
+        self.response.set_status(202)
+
+
+class ExpireIdempotencyKeysHandler(webapp2.RequestHandler):
+    def get(self):
+        """Delete idempotency records past their TTL, a page per task."""
+        self.post()
+
+    def post(self):
+        deleted = ConferenceApi._expireIdempotencyRecords(
+            self.request.get('cursor') or None)
+        logging.info('Deleted %d expired idempotency records', deleted)
+        self.response.set_status(204)
+
+
+class ImportHandler(webapp2.RequestHandler):
+    def post(self):
+        """Stream an uploaded JSONL or CSV file into chunked import tasks."""
+        # use GET params only, so the body is left for streaming
+        organizer = self.request.GET.get('organizerUserId')
+        job_id = self.request.GET.get('jobId') or uuid.uuid4().hex
+        fmt = self.request.GET.get('format', 'jsonl')
+        if not organizer or fmt not in ('jsonl', 'csv') or not JOB_ID_RE.match(job_id):
+            self.abort(400, 'organizerUserId, format (jsonl|csv) and a valid jobId are required')
+        job = bulk.enqueueImport(job_id, organizer, self.request.body_file, fmt)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'jobId': job_id,
+            'recordsEnqueued': job.recordsEnqueued,
+            'chunksEnqueued': job.chunksEnqueued,
+        }))
+
+
+class ImportChunkHandler(webapp2.RequestHandler):
+    def post(self):
+        """Write one chunk of imported conferences and sessions."""
+        bulk.importChunk(self.request.get('jobId'),
+                         int(self.request.get('chunk')))
+        self.response.set_status(204)
+
+
+class ExportHandler(webapp2.RequestHandler):
+    def get(self):
+        """Export conferences with their sessions, a cursor page at a time."""
+        fmt = self.request.get('format', 'jsonl')
+        if fmt not in ('jsonl', 'csv'):
+            self.abort(400, 'format must be jsonl or csv')
+        self.response.headers['Content-Type'] = (
+            'text/csv' if fmt == 'csv' else 'application/x-ndjson')
+        try:
+            cursor = bulk.exportConferences(self.response.out,
+                self.request.get('cursor') or None, fmt)
+        except BadCursorError:
+            self.abort(400, 'Invalid cursor')
+        # clients repeat the request with this cursor until it is absent
+        if cursor:
+            self.response.headers['X-Next-Cursor'] = cursor
+
+
+class RosterHandler(webapp2.RequestHandler):
+    def get(self, wsck):
+        """Export a conference's attendees, a cursor page at a time; organizer only."""
+        fmt = self.request.get('format', 'jsonl')
+        if fmt not in ('jsonl', 'csv'):
+            self.abort(400, 'format must be jsonl or csv')
+        try:
+            conf_key = ndb.Key(urlsafe=wsck)
+        except Exception:
+            self.abort(400, 'Conference not found for key: %s' % wsck)
+        user = users.get_current_user()
+        if not user:
+            self.abort(401, 'Authorization required')
+        # the conference key's parent is its organizer's Profile
+        if conf_key.parent() is None or conf_key.parent().id() != getUserId(user):
+            self.abort(403, 'Only the owner can export the conference roster.')
+        if not repo.get(conf_key):
+            self.abort(404, 'No conference found with key: %s' % wsck)
+        self.response.headers['Content-Type'] = (
+            'text/csv' if fmt == 'csv' else 'application/x-ndjson')
+        try:
+            cursor = bulk.exportRoster(self.response.out, wsck,
+                self.request.get('cursor') or None, fmt)
+        except BadCursorError:
+            self.abort(400, 'Invalid cursor')
+        # clients repeat the request with this cursor until it is absent
+        if cursor:
+            self.response.headers['X-Next-Cursor'] = cursor
+
+
+class CacheStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return this instance's L1 cache size, hit rate & evictions."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(l1.stats()))
+
+
+class ProfileHandler(webapp2.RequestHandler):
+    def get(self):
+        """Show sampling rates & samples, or one endpoint's profile."""
+        endpoint = self.request.get('endpoint')
+        if not endpoint:
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps({
+                'rates': profiler.rates(),
+                'samples': profiler.samples(),
+            }))
+            return
+        if self.request.get('format') == 'pstats':
+            dump = profiler.dump(endpoint)
+            if dump is None:
+                self.abort(404, 'no samples for %s' % endpoint)
+            self.response.headers['Content-Type'] = 'application/octet-stream'
+            self.response.headers['Content-Disposition'] = (
+                'attachment; filename="%s.pstats"' % re.sub(r'\W', '_', endpoint))
+            self.response.write(dump)
+            return
+        sort = self.request.get('sort', 'cumulative')
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            self.abort(400, 'sort must be one of %s' % ', '.join(
+                sorted(pstats.Stats.sort_arg_dict_default)))
+        try:
+            limit = int(self.request.get('limit', 30))
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            self.abort(400, 'limit must be a positive integer')
+        top = profiler.top(endpoint, sort, limit)
+        if top is None:
+            self.abort(404, 'no samples for %s' % endpoint)
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(top)
+
+    def post(self):
+        """Set an endpoint's sampling rate, or reset collected stats."""
+        endpoint = self.request.get('endpoint') or None
+        if self.request.get('reset'):
+            profiler.reset(endpoint)
+        elif endpoint:
+            try:
+                rate = float(self.request.get('rate', 0))
+            except ValueError:
+                self.abort(400, 'rate must be a number between 0 and 1')
+            profiler.setRate(endpoint, rate)
+        else:
+            self.abort(400, 'endpoint and rate, or reset, are required')
+        self.response.set_status(204)
+
+
+app = profiled(webapp2.WSGIApplication([
+    ('/_ah/warmup', WarmupHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/send_confirmation_emails', SendConfirmationEmailsHandler),
+    ('/crons/sweep_profiles', StartProfileSweepHandler),
+    ('/crons/expire_idempotency_keys', ExpireIdempotencyKeysHandler),
+    ('/crons/resume_conference_deletions', ResumeConferenceDeletionsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
      ('/tasks/cache_featured_speaker', CacheFeaturedSpeakerHandler),
-], debug=True)
+    ('/tasks/import_chunk', ImportChunkHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/tasks/drain_registrations', DrainRegistrationsHandler),
+    ('/tasks/sweep_profiles', SweepProfilesHandler),
+    ('/tasks/rebuild_dashboard', RebuildDashboardHandler),
+    ('/tasks/refresh_speaker_leaderboard', RefreshSpeakerLeaderboardHandler),
+    ('/tasks/recount_speaker', RecountSpeakerHandler),
+    ('/tasks/expire_idempotency_keys', ExpireIdempotencyKeysHandler),
+    ('/tasks/copy_conference_fields', CopyConferenceFieldsHandler),
+    ('/tasks/delete_conference_sessions', DeleteConferenceSessionsHandler),
+    ('/admin/import', ImportHandler),
+    ('/admin/export', ExportHandler),
+    ('/roster/(.+)', RosterHandler),
+    ('/admin/cache_stats', CacheStatsHandler),
+    ('/admin/profile', ProfileHandler),
+    ('/admin/backfill_session_fields', BackfillSessionFieldsHandler),
+], debug=True))
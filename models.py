@@ -17,17 +17,84 @@ import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
+from repository import repo
+
 class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
-class Profile(ndb.Model):
+class SoldOutException(ConflictException):
+    """SoldOutException -- ConflictException raised when no seats are left"""
+
+class TooManyRequestsException(endpoints.ServiceException):
+    """TooManyRequestsException -- exception mapped to HTTP 429 response"""
+    http_status = 429
+
+class TrackedModel(ndb.Model):
+    """TrackedModel -- model that knows which properties changed since it
+    was loaded or last written, so unchanged entities are not re-put
+    """
+
+    @classmethod
+    def _from_pb(cls, pb, set_key=True, ent=None, key=None):
+        ent = super(TrackedModel, cls)._from_pb(pb, set_key=set_key, ent=ent, key=key)
+        # kept as loaded, and only decoded again if asked what changed,
+        # which most reads never are
+        ent._trackedPb = pb
+        return ent
+
+    def _post_put_hook(self, future):
+        if future.get_exception() is None:
+            self._trackedPb = self._to_pb()
+
+    def _savedValues(self):
+        """Property values as loaded or last put, or None."""
+        pb = getattr(self, '_trackedPb', None)
+        if pb is None:
+            return None
+        return super(TrackedModel, type(self))._from_pb(pb).to_dict()
+
+    def changedProperties(self):
+        """Names of properties changed since load or last put; all of
+        them for an entity that was never loaded or put.
+        """
+        values = self.to_dict()
+        saved = self._savedValues()
+        if saved is None:
+            return set(values)
+        return set(name for name, value in values.items()
+                   if name not in saved or saved[name] != value)
+
+    def isDirty(self):
+        return bool(self.changedProperties())
+
+    def putIfChanged(self):
+        """Put the entity only if it changed; return whether it was put."""
+        if not self.isDirty():
+            return False
+        repo.put(self)
+        return True
+
+
+def putChanged(entities):
+    """Write the changed entities among entities in one put_multi."""
+    changed = [entity for entity in entities if entity.isDirty()]
+    if changed:
+        repo.putMulti(changed)
+    return changed
+
+class Profile(TrackedModel):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     SessionsInWishlist = ndb.StringProperty(repeated=True)
+    # wishlist time slots, sorted by start (see intervals.SortedIntervals)
+    wishlistStarts = ndb.IntegerProperty(repeated=True, indexed=False)
+    wishlistEnds = ndb.IntegerProperty(repeated=True, indexed=False)
+    wishlistSlotKeys = ndb.StringProperty(repeated=True, indexed=False)
+    wishlistMaxMinutes = ndb.IntegerProperty(default=0, indexed=False)
 
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -49,7 +116,7 @@ class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
     data = messages.BooleanField(1)
 
-class Conference(ndb.Model):
+class Conference(TrackedModel):
     """Conference -- Conference object"""
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
@@ -77,10 +144,102 @@ class ConferenceForm(messages.Message):
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
 
+class ConferenceDashboard(ndb.Model):
+    """ConferenceDashboard -- materialized organizer summary; child of its Conference"""
+    sessionCount    = ndb.IntegerProperty(default=0, indexed=False)
+    sessionTypeCounts = ndb.JsonProperty(indexed=False)    # type -> count
+    speakerCounts   = ndb.JsonProperty(indexed=False)      # speaker -> count
+    registrations   = ndb.IntegerProperty(default=0, indexed=False)
+    maxAttendees    = ndb.IntegerProperty(default=0, indexed=False)
+
+class CountForm(messages.Message):
+    """CountForm -- a named count"""
+    name            = messages.StringField(1)
+    count           = messages.IntegerField(2)
+
+class ConferenceDashboardForm(messages.Message):
+    """ConferenceDashboardForm -- organizer summary outbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    sessionCount    = messages.IntegerField(2)
+    sessionTypeCounts = messages.MessageField(CountForm, 3, repeated=True)
+    speakerCount    = messages.IntegerField(4)
+    speakerCounts   = messages.MessageField(CountForm, 5, repeated=True)
+    registrations   = messages.IntegerField(6)
+    maxAttendees    = messages.IntegerField(7)
+    seatsAvailable  = messages.IntegerField(8)
+    fillRate        = messages.FloatField(9)
+
+class SpeakerCounter(ndb.Model):
+    """SpeakerCounter -- sessions per speaker across conferences; keyed by speaker"""
+    sessionCount    = ndb.IntegerProperty(default=0, indexed=False)
+    typeCounts      = ndb.JsonProperty(indexed=False)      # type -> count
+    monthCounts     = ndb.JsonProperty(indexed=False)      # month -> count
+
+class SpeakerLeaderboard(ndb.Model):
+    """SpeakerLeaderboard -- top speakers overall, per type & per month"""
+    rankings        = ndb.JsonProperty(indexed=False)      # ranking -> [[speaker, count]]
+    refreshed       = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class TopSpeakersForm(messages.Message):
+    """TopSpeakersForm -- ranked speakers & when the ranking was computed"""
+    items           = messages.MessageField(CountForm, 1, repeated=True)
+    refreshed       = messages.StringField(2)
+
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- a user waiting for a seat; keyed <websafeConferenceKey>:<userId>"""
+    websafeConferenceKey = ndb.StringProperty(required=True)
+    userId          = ndb.StringProperty(required=True, indexed=False)
+    enqueued        = ndb.DateTimeProperty(auto_now_add=True)
+
+class WaitlistForm(messages.Message):
+    """WaitlistForm -- a user's place on a conference waitlist; 0 when not on it"""
+    websafeConferenceKey = messages.StringField(1)
+    position        = messages.IntegerField(2)
+
+class RegistrationTicket(ndb.Model):
+    """RegistrationTicket -- a queued registration & its outcome"""
+    websafeConferenceKey = ndb.StringProperty(required=True, indexed=False)
+    userId          = ndb.StringProperty(required=True, indexed=False)
+    status          = ndb.StringProperty(default='PENDING', indexed=False)
+    created         = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+class RegistrationTicketForm(messages.Message):
+    """RegistrationTicketForm -- queued registration outbound form message"""
+    ticket          = messages.StringField(1)
+    websafeConferenceKey = messages.StringField(2)
+    status          = messages.EnumField('RegistrationStatus', 3)
+
+class RegistrationStatus(messages.Enum):
+    """RegistrationStatus -- outcome of a queued registration"""
+    PENDING = 1
+    REGISTERED = 2
+    ALREADY_REGISTERED = 3
+    WAITLISTED = 4
+    NOT_FOUND = 5
+
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
 
+class ConferencePageForm(messages.Message):
+    """ConferencePageForm -- one page of conferences & the next page's cursor"""
+    items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+
+class WebsafeKeysForm(messages.Message):
+    """WebsafeKeysForm -- list of websafe keys inbound form message"""
+    websafeKeys = messages.StringField(1, repeated=True)
+
+class ConferenceBatchItem(messages.Message):
+    """ConferenceBatchItem -- one requested key & its Conference, if found"""
+    websafeKey      = messages.StringField(1)
+    found           = messages.BooleanField(2)
+    conference      = messages.MessageField(ConferenceForm, 3)
+
+class ConferenceBatchForms(messages.Message):
+    """ConferenceBatchForms -- ConferenceBatchItem per requested key, in order"""
+    items = messages.MessageField(ConferenceBatchItem, 1, repeated=True)
+
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
     NOT_SPECIFIED = 1
@@ -109,7 +268,7 @@ class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
 
-class Session(ndb.Model):
+class Session(TrackedModel):
     """Session -- Session object"""
     sessionName     = ndb.StringProperty(required=True)
     highlights      = ndb.StringProperty(default = '')
@@ -118,6 +277,10 @@ class Session(ndb.Model):
     sessionDate     = ndb.DateProperty(required=True)
     startTime       = ndb.TimeProperty(required=True)
     duration        = ndb.IntegerProperty(default = 50) 
+    # copied from the parent conference, for searchSessions
+    conferenceCity  = ndb.StringProperty()
+    conferenceMonth = ndb.IntegerProperty()
+    conferenceTopics = ndb.StringProperty(repeated=True)
      
 class SessionForm(messages.Message):
     """SessionForm -- Session Form for outbound message"""
@@ -134,10 +297,98 @@ class SessionForms(messages.Message):
      """SessionForms -- Multiple Session Forms one per session"""
      items = messages.MessageField(SessionForm, 1, repeated=True)
 
+class AgendaPageForm(messages.Message):
+    """AgendaPageForm -- one page of a conference agenda, all from one day"""
+    sessionDate     = messages.StringField(1)
+    items           = messages.MessageField(SessionForm, 2, repeated=True)
+    nextCursor      = messages.StringField(3)
+
+class SessionPageForm(messages.Message):
+    """SessionPageForm -- one page of sessions & the cursor to the next"""
+    items           = messages.MessageField(SessionForm, 1, repeated=True)
+    nextCursor      = messages.StringField(2)
+
+class SessionBatchItem(messages.Message):
+    """SessionBatchItem -- one requested key & its Session, if found"""
+    websafeKey      = messages.StringField(1)
+    found           = messages.BooleanField(2)
+    session         = messages.MessageField(SessionForm, 3)
+
+class SessionBatchForms(messages.Message):
+    """SessionBatchForms -- SessionBatchItem per requested key, in order"""
+    items = messages.MessageField(SessionBatchItem, 1, repeated=True)
+
+class WishlistAddForm(messages.Message):
+    """WishlistAddForm -- result of adding a session, with wishlist sessions it overlaps"""
+    data = messages.BooleanField(1)
+    conflicts = messages.StringField(2, repeated=True)
+
+class WishlistConflictForm(messages.Message):
+    """WishlistConflictForm -- two wishlist sessions whose time slots overlap"""
+    websafeSessionKey = messages.StringField(1)
+    conflictingSessionKey = messages.StringField(2)
+
+class WishlistConflictForms(messages.Message):
+    """WishlistConflictForms -- multiple WishlistConflictForm outbound form message"""
+    items = messages.MessageField(WishlistConflictForm, 1, repeated=True)
+
+class SessionNowNextForm(messages.Message):
+    """SessionNowNextForm -- sessions running now and the ones starting next"""
+    now = messages.MessageField(SessionForm, 1, repeated=True)
+    next = messages.MessageField(SessionForm, 2, repeated=True)
+
     
 class SessionType(messages.Enum):
     """Session Type Enumeration Value"""
     NOT_SPECIFIED = 1
     LECTURE = 2
     KEYNOTE = 3
-    WORKSHOP = 4
\ No newline at end of file
+    WORKSHOP = 4
+
+class ImportJob(ndb.Model):
+    """ImportJob -- checkpoint of a streaming bulk import"""
+    organizerUserId = ndb.StringProperty(required=True)
+    format          = ndb.StringProperty(default='jsonl')
+    recordsEnqueued = ndb.IntegerProperty(default=0)
+    chunksEnqueued  = ndb.IntegerProperty(default=0)
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+
+class ImportChunk(ndb.Model):
+    """ImportChunk -- records, allocated keys and completion of one import task"""
+    jobId           = ndb.StringProperty(required=True)
+    records         = ndb.JsonProperty(compressed=True)    # dropped once done
+    allocated       = ndb.BooleanProperty(default=False, indexed=False)
+    keys            = ndb.KeyProperty(repeated=True, indexed=False)
+    done            = ndb.BooleanProperty(default=False)
+    failed          = ndb.IntegerProperty(default=0, indexed=False)
+    rejected        = ndb.IntegerProperty(repeated=True, indexed=False)   # record indexes
+
+class SweepCheckpoint(ndb.Model):
+    """SweepCheckpoint -- resume point of a background sweep over a kind"""
+    cursor          = ndb.StringProperty(indexed=False)
+    running         = ndb.BooleanProperty(default=False, indexed=False)
+    updated         = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class ConferenceDeletion(ndb.Model):
+    """ConferenceDeletion -- progress of the cascade deleting a deleted conference's sessions, keyed by websafeConferenceKey"""
+    sessionsDeleted = ndb.IntegerProperty(default=0, indexed=False)
+    running         = ndb.BooleanProperty(default=True)
+    updated         = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class IdempotencyRecord(ndb.Model):
+    """IdempotencyRecord -- response to a create request, keyed by user, method & client key"""
+    response        = ndb.TextProperty()                   # protojson encoded
+    expires         = ndb.DateTimeProperty()
+
+class CompactColumn(messages.Message):
+    """CompactColumn -- one field of a list response as parallel arrays"""
+    name            = messages.StringField(1)
+    strings         = messages.StringField(2, repeated=True)
+    ints            = messages.IntegerField(3, repeated=True, variant=messages.Variant.INT32)
+    dictionary      = messages.StringField(4, repeated=True)
+    lengths         = messages.IntegerField(5, repeated=True, variant=messages.Variant.INT32)
+
+class CompactForms(messages.Message):
+    """CompactForms -- columnar outbound list message, see compact.py"""
+    count           = messages.IntegerField(1, variant=messages.Variant.INT32)
+    columns         = messages.MessageField(CompactColumn, 2, repeated=True)
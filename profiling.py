@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""profiling.py
+
+Conference Central sampling request profiler
+
+profiled(wsgi_app) runs cProfile on a sampled fraction of the requests to
+each endpoint; an endpoint is an API method ('ConferenceApi.getConference')
+or a main.py route ('/tasks/import_chunk', '/roster/(.+)'). Sampling rates
+are set per endpoint through /admin/profile and shared by all instances
+through memcache, which each instance re-reads at most every
+RATES_CHECK_SECONDS; endpoints without a rate are never profiled. Stats are merged per endpoint in the
+memory of each instance, and read back from the same handler as the top
+functions or as a pstats dump.
+
+"""
+
+import cProfile
+import marshal
+import pstats
+import random
+import threading
+import time
+from StringIO import StringIO
+
+import webapp2
+from google.appengine.api import memcache
+
+PROFILE_RATES_KEY = 'PROFILE_RATES'
+RATES_CHECK_SECONDS = 5
+SPI_PREFIX = '/_ah/spi/'
+UNMATCHED_ENDPOINT = '(unmatched)'
+
+
+class EndpointProfiler(object):
+    """Per-endpoint merged cProfile stats for this instance."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}        # endpoint -> pstats.Stats
+        self._samples = {}      # endpoint -> profiled request count
+        self._rates = (None, 0) # (rates, checked at)
+
+    def rates(self):
+        """Sampling rate per endpoint, as set through setRate."""
+        rates, checked = self._rates
+        if rates is None or time.time() - checked >= RATES_CHECK_SECONDS:
+            rates = memcache.get(PROFILE_RATES_KEY) or {}
+            self._rates = (rates, time.time())
+        return rates
+
+    def setRate(self, endpoint, rate):
+        """Profile rate (0 to 1) of the requests to endpoint; 0 disables."""
+        rates = dict(memcache.get(PROFILE_RATES_KEY) or {})
+        if rate > 0:
+            rates[endpoint] = min(rate, 1.0)
+        else:
+            rates.pop(endpoint, None)
+        memcache.set(PROFILE_RATES_KEY, rates)
+        self._rates = (rates, time.time())
+        return rates
+
+    def call(self, endpoint, func, *args, **kwargs):
+        """Call func, under cProfile if this request is sampled."""
+        rate = self.rates().get(endpoint)
+        if not rate or random.random() >= rate:
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self._merge(endpoint, profile)
+
+    def _merge(self, endpoint, profile):
+        with self._lock:
+            if endpoint in self._stats:
+                self._stats[endpoint].add(profile)
+            else:
+                self._stats[endpoint] = pstats.Stats(profile, stream=StringIO())
+            self._samples[endpoint] = self._samples.get(endpoint, 0) + 1
+
+    def samples(self):
+        """Profiled request count per endpoint."""
+        with self._lock:
+            return dict(self._samples)
+
+    def top(self, endpoint, sort='cumulative', limit=30):
+        """The top functions of endpoint as pstats text, or None."""
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                return None
+            stats.stream = out = StringIO()
+            stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def dump(self, endpoint):
+        """Merged stats of endpoint in pstats dump format, or None; load
+        with pstats.Stats(filename).
+        """
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            return marshal.dumps(stats.stats) if stats else None
+
+    def reset(self, endpoint=None):
+        """Drop the stats of endpoint, or of every endpoint."""
+        with self._lock:
+            if endpoint:
+                self._stats.pop(endpoint, None)
+                self._samples.pop(endpoint, None)
+            else:
+                self._stats.clear()
+                self._samples.clear()
+
+
+def profiled(app):
+    """Wrap a WSGI app so its requests are sampled by profiler."""
+    router = getattr(app, 'router', None)
+    def wrapper(environ, start_response):
+        endpoint = environ.get('PATH_INFO', '')
+        if endpoint.startswith(SPI_PREFIX):
+            endpoint = endpoint[len(SPI_PREFIX):]
+        elif router:
+            endpoint = _routeTemplate(router, environ)
+        return profiler.call(endpoint, app, environ, start_response)
+    return wrapper
+
+
+def _routeTemplate(router, environ):
+    """Template of the webapp2 route a request matches, so paths with
+    keys in them count as one endpoint.
+    """
+    try:
+        match = router.match(webapp2.Request(environ))
+    except Exception:
+        match = None
+    if not match:
+        return UNMATCHED_ENDPOINT
+    # SimpleRoute anchors its template once it has been matched
+    return match[0].template.lstrip('^').rstrip('$')
+
+
+# one profiler per instance, shared by all request threads
+profiler = EndpointProfiler()
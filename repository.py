@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+
+"""repository.py
+
+Conference Central storage repository
+
+All datastore access goes through repo, so the API runs against the App
+Engine datastore (NdbRepository, the default) or against a local SQLite
+file (SqliteRepository), for large-dataset benchmarks and experiments at
+laptop speeds. Set CONFERENCE_STORAGE=sqlite:<path> before the app is
+imported to pick SQLite; a bare 'sqlite' keeps the data in memory.
+
+Both backends take and return ndb models and keys, and queries take ndb
+filter and order expressions (Conference.city == 'London',
+-Conference.startDate), so callers are written once. Cursors are plain
+strings.
+
+"""
+
+import functools
+import os
+import threading
+from datetime import date
+from datetime import datetime
+from datetime import time
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import datastore_types
+from google.appengine.datastore import datastore_query
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import query as ndb_query
+
+STORAGE_ENV = 'CONFERENCE_STORAGE'
+SQLITE_BATCH = 500              # keys per SQL statement, below SQLite's 999 limit
+
+
+class BadCursorError(ValueError):
+    """BadCursorError -- a query cursor that can't be decoded"""
+
+
+class Result(object):
+    """A result that may still be on its way; get_result() waits for it."""
+
+    def __init__(self, get):
+        self._get = get
+
+    def get_result(self):
+        return self._get()
+
+
+def transactional(**options):
+    """Decorator running the function in a repo transaction, joining the
+    caller's transaction if there is one; options as for ndb.transaction.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return repo.transaction(lambda: func(*args, **kwargs), **options)
+        return wrapper
+    return decorator
+
+# - - - ndb - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+class NdbRepository(object):
+    """The App Engine datastore, through ndb."""
+
+    def get(self, key):
+        return key.get()
+
+    def getMulti(self, keys, useCache=True):
+        """Entities for keys, None where missing; pass useCache=False when
+        streaming many entities, so they aren't all kept in the request's
+        context cache.
+        """
+        return ndb.get_multi(keys, use_cache=useCache)
+
+    def put(self, entity):
+        return entity.put()
+
+    def putMulti(self, entities):
+        return ndb.put_multi(entities)
+
+    def delete(self, key):
+        key.delete()
+
+    def deleteMulti(self, keys):
+        ndb.delete_multi(keys)
+
+    def allocateIds(self, model, size, parent=None):
+        """First of size consecutive new ids for model under parent."""
+        return model.allocate_ids(size=size, parent=parent)[0]
+
+    def allocateIdsAsync(self, model, size, parent=None):
+        future = model.allocate_ids_async(size=size, parent=parent)
+        return Result(lambda: future.get_result()[0])
+
+    def getOrInsert(self, model, id, parent=None, **values):
+        return model.get_or_insert(id, parent=parent, **values)
+
+    def query(self, model, *filters, **options):
+        """Query over model; options are ancestor and orders."""
+        q = model.query(*filters, ancestor=options.get('ancestor'))
+        if options.get('orders'):
+            q = q.order(*options['orders'])
+        return NdbQuery(q)
+
+    def transaction(self, callback, **options):
+        options.setdefault('propagation', ndb.TransactionOptions.ALLOWED)
+        return ndb.transaction(callback, **options)
+
+    def inTransaction(self):
+        return ndb.in_transaction()
+
+
+class NdbQuery(object):
+    """Repository query over an ndb.Query."""
+
+    def __init__(self, q):
+        self._q = q
+
+    def filter(self, *filters):
+        return NdbQuery(self._q.filter(*filters))
+
+    def order(self, *orders):
+        return NdbQuery(self._q.order(*orders))
+
+    def __iter__(self):
+        return iter(self._q)
+
+    def iter(self, batchSize=None):
+        return self._q.iter(batch_size=batchSize)
+
+    def fetch(self, limit=None, keysOnly=False, projection=None):
+        if projection:
+            return self._q.fetch(limit, projection=projection)
+        return self._q.fetch(limit, keys_only=keysOnly)
+
+    def fetchAsync(self, limit=None, keysOnly=False):
+        return self._q.fetch_async(limit, keys_only=keysOnly)
+
+    def fetchPage(self, pageSize, cursor=None, keysOnly=False):
+        """(results, cursor for the next page or None when done)"""
+        start = self._cursor(cursor)
+        try:
+            results, nextCursor, more = self._q.fetch_page(pageSize,
+                start_cursor=start, keys_only=keysOnly)
+        except (datastore_errors.BadRequestError, datastore_errors.BadValueError):
+            # a cursor that decodes can still be corrupt or of another query
+            if not start:
+                raise
+            raise BadCursorError('Invalid cursor: %s' % cursor)
+        return results, nextCursor.urlsafe() if more and nextCursor else None
+
+    def iterWithCursors(self, cursor=None, batchSize=None):
+        """Yield (result, cursor after result) from cursor on."""
+        it = self._q.iter(start_cursor=self._cursor(cursor),
+                          produce_cursors=True, batch_size=batchSize)
+        for result in it:
+            yield result, it.cursor_after().urlsafe()
+
+    def count(self, limit=None):
+        return self._q.count(limit)
+
+    def get(self):
+        return self._q.get()
+
+    @staticmethod
+    def _cursor(cursor):
+        if not cursor:
+            return None
+        try:
+            return ndb_query.Cursor(urlsafe=cursor)
+        except Exception:
+            raise BadCursorError('Invalid cursor: %s' % cursor)
+
+# - - - SQLite - - - - - - - - - - - - - - - - - - - - - - - -
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    key TEXT PRIMARY KEY, kind TEXT NOT NULL, pb BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS entities_kind ON entities (kind, key);
+CREATE TABLE IF NOT EXISTS ancestors (
+    key TEXT NOT NULL, ancestor TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS ancestors_ancestor ON ancestors (ancestor, key);
+CREATE INDEX IF NOT EXISTS ancestors_key ON ancestors (key);
+CREATE TABLE IF NOT EXISTS properties (
+    key TEXT NOT NULL, kind TEXT NOT NULL, name TEXT NOT NULL, value);
+CREATE INDEX IF NOT EXISTS properties_value ON properties (kind, name, value, key);
+CREATE INDEX IF NOT EXISTS properties_key ON properties (key, name, value);
+CREATE TABLE IF NOT EXISTS ids (
+    kind TEXT PRIMARY KEY, next INTEGER NOT NULL);
+"""
+
+
+NULL_TESTS = {'=': 'value IS NULL', '<=': 'value IS NULL', '<': '0',
+              '>=': '1', '>': 'value IS NOT NULL'}
+
+
+def _sqlValue(value):
+    """A datastore value as stored in properties.value, so that SQLite
+    compares and sorts values of one type the way the datastore does.
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, datastore_types.Key):
+        return ndb.Key.from_old_key(value).urlsafe()
+    if isinstance(value, ndb.Key):
+        return value.urlsafe()
+    # dates & times are stored as datetimes, as ndb does
+    if isinstance(value, time):
+        value = datetime.combine(date(1970, 1, 1), value)
+    elif isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime.combine(value, time())
+    if isinstance(value, datetime):
+        return u'%04d-%02d-%02d %02d:%02d:%02d.%06d' % (value.year, value.month,
+            value.day, value.hour, value.minute, value.second, value.microsecond)
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    if value is None or isinstance(value, (int, long, float, unicode)):
+        return value
+    return unicode(value)
+
+
+class SqliteRepository(object):
+    """Entities in one SQLite file, as encoded ndb protobufs, with their
+    indexed property values and ancestors in indexed side tables.
+
+    One connection is shared by all threads under a lock, which a
+    transaction holds from start to commit; transactions are serialized,
+    so they never fail on contention.
+    """
+
+    def __init__(self, path=':memory:'):
+        import sqlite3      # not available on App Engine
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.executescript(SQLITE_SCHEMA)
+        self._lock = threading.RLock()
+        self._depth = 0         # transaction nesting of the lock holder
+
+    def _run(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def get(self, key):
+        return self.getMulti([key])[0]
+
+    def getMulti(self, keys, useCache=True):
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), SQLITE_BATCH):
+                batch = [key.urlsafe() for key in keys[i:i + SQLITE_BATCH]]
+                for urlsafe, pb in self._run(
+                        'SELECT key, pb FROM entities WHERE key IN (%s)'
+                        % ','.join('?' * len(batch)), batch):
+                    found[urlsafe] = pb
+        return [self._decode(found[key.urlsafe()]) if key.urlsafe() in found
+                else None for key in keys]
+
+    def put(self, entity):
+        return self.putMulti([entity])[0]
+
+    def putMulti(self, entities):
+        entities = list(entities)
+        for entity in entities:
+            entity._prepare_for_put()
+            entity._pre_put_hook()
+        self.transaction(lambda: [self._write(entity) for entity in entities])
+        for entity in entities:
+            future = ndb.Future()
+            future.set_result(entity.key)
+            entity._post_put_hook(future)
+        return [entity.key for entity in entities]
+
+    def _write(self, entity):
+        if not entity.key or not entity.key.id():
+            parent = entity.key.parent() if entity.key else None
+            entity.key = ndb.Key(entity._get_kind(), self.allocateIds(
+                entity.__class__, 1), parent=parent)
+        key = entity.key
+        urlsafe = key.urlsafe()
+        pb = entity._to_pb()
+        self._delete([urlsafe])
+        self._db.execute('INSERT INTO entities VALUES (?, ?, ?)',
+                         (urlsafe, key.kind(), buffer(pb.Encode())))
+        ancestor = key
+        while ancestor:
+            self._db.execute('INSERT INTO ancestors VALUES (?, ?)',
+                             (urlsafe, ancestor.urlsafe()))
+            ancestor = ancestor.parent()
+        self._db.executemany('INSERT INTO properties VALUES (?, ?, ?, ?)',
+            [(urlsafe, key.kind(), prop.name().decode('utf-8'),
+              _sqlValue(datastore_types.FromPropertyPb(prop)))
+             for prop in pb.property_list()])
+
+    def delete(self, key):
+        self.deleteMulti([key])
+
+    def deleteMulti(self, keys):
+        keys = [key.urlsafe() for key in keys]
+        self.transaction(lambda: [self._delete(keys[i:i + SQLITE_BATCH])
+                                  for i in range(0, len(keys), SQLITE_BATCH)])
+
+    def _delete(self, urlsafes):
+        marks = ','.join('?' * len(urlsafes))
+        for table in ('entities', 'ancestors', 'properties'):
+            self._db.execute('DELETE FROM %s WHERE key IN (%s)' % (table, marks),
+                             urlsafes)
+
+    def allocateIds(self, model, size, parent=None):
+        """First of size consecutive new ids; ids are per kind."""
+        kind = model._get_kind()
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO ids VALUES (?, 1)', (kind,))
+            self._db.execute('UPDATE ids SET next = next + ? WHERE kind = ?',
+                             (size, kind))
+            return self._run('SELECT next FROM ids WHERE kind = ?',
+                             (kind,))[0][0] - size
+
+    def allocateIdsAsync(self, model, size, parent=None):
+        first = self.allocateIds(model, size, parent)
+        return Result(lambda: first)
+
+    def getOrInsert(self, model, id, parent=None, **values):
+        key = ndb.Key(model, id, parent=parent)
+        def txn():
+            entity = self.get(key)
+            if entity is None:
+                entity = model(key=key, **values)
+                self.put(entity)
+            return entity
+        return self.transaction(txn)
+
+    def query(self, model, *filters, **options):
+        return SqliteQuery(self, model._get_kind(), options.get('ancestor'),
+                           list(filters), list(options.get('orders') or ()))
+
+    def transaction(self, callback, **options):
+        with self._lock:
+            if self._depth:
+                return callback()
+            self._db.execute('BEGIN IMMEDIATE')
+            self._depth += 1
+            try:
+                result = callback()
+            except ndb.Rollback:
+                self._db.execute('ROLLBACK')
+                return None
+            except:
+                self._db.execute('ROLLBACK')
+                raise
+            finally:
+                self._depth -= 1
+            self._db.execute('COMMIT')
+            return result
+
+    def inTransaction(self):
+        with self._lock:
+            return self._depth > 0
+
+    def _decode(self, pb):
+        return ndb.ModelAdapter().pb_to_entity(entity_pb.EntityProto(str(pb)))
+
+
+class SqliteQuery(object):
+    """Repository query compiled to SQL over the side tables; cursors are
+    offsets, so they shift if entities are added before them.
+    """
+
+    def __init__(self, repo, kind, ancestor, filters, orders):
+        self._repo = repo
+        self._kind = kind
+        self._ancestor = ancestor
+        self._filters = filters
+        self._orders = orders
+
+    def filter(self, *filters):
+        return SqliteQuery(self._repo, self._kind, self._ancestor,
+                           self._filters + list(filters), self._orders)
+
+    def order(self, *orders):
+        return SqliteQuery(self._repo, self._kind, self._ancestor,
+                           self._filters, self._orders + list(orders))
+
+    def _where(self):
+        """SQL condition on entities e and its parameters."""
+        clauses = ['e.kind = ?']
+        params = [self._kind]
+        if self._ancestor:
+            clauses.append('e.key IN (SELECT key FROM ancestors WHERE ancestor = ?)')
+            params.append(self._ancestor.urlsafe())
+        for node in self._filters:
+            clause, nodeParams = self._filterSql(node)
+            clauses.append(clause)
+            params.extend(nodeParams)
+        for name, _ in self._orderNames():
+            # the datastore leaves out entities without the order property
+            clauses.append('e.key IN (SELECT key FROM properties '
+                           'WHERE kind = ? AND name = ?)')
+            params.extend([self._kind, name])
+        return ' AND '.join(clauses), params
+
+    def _filterSql(self, node):
+        if isinstance(node, (ndb_query.ConjunctionNode, ndb_query.DisjunctionNode)):
+            parts = [self._filterSql(child) for child in node]
+            joiner = ' AND ' if isinstance(node, ndb_query.ConjunctionNode) else ' OR '
+            return ('(%s)' % joiner.join(sql for sql, _ in parts),
+                    [param for _, params in parts for param in params])
+        if not isinstance(node, ndb_query.FilterNode):
+            raise TypeError('Unsupported filter for SQLite: %r' % (node,))
+        name, op, value = node.__getnewargs__()
+        value = _sqlValue(value)
+        if value is None:
+            # null sorts below every other value
+            test = NULL_TESTS[op]
+            params = [self._kind, name]
+        else:
+            test = 'value %s ?' % op
+            params = [self._kind, name, value]
+        return ('e.key IN (SELECT key FROM properties '
+                'WHERE kind = ? AND name = ? AND %s)' % test), params
+
+    def _orderNames(self):
+        """(property name, descending) per order."""
+        names = []
+        for order in self._orders:
+            if isinstance(order, ndb.Property):
+                names.append((order._name, False))
+            else:
+                names.append((order.prop,
+                              order.direction == datastore_query.PropertyOrder.DESCENDING))
+        return names
+
+    def _select(self, columns, limit=None, offset=0):
+        where, params = self._where()
+        terms = []
+        for name, descending in self._orderNames():
+            # repeated properties sort by their lowest, or highest, value
+            terms.append('(SELECT %s(value) FROM properties p WHERE p.key = e.key '
+                         'AND p.name = ?) %s' % ('MAX' if descending else 'MIN',
+                                                 'DESC' if descending else 'ASC'))
+            params.append(name)
+        terms.append('e.key')
+        sql = 'SELECT %s FROM entities e WHERE %s ORDER BY %s LIMIT ? OFFSET ?' % (
+            columns, where, ', '.join(terms))
+        return self._repo._run(sql, params + [-1 if limit is None else limit, offset])
+
+    def _results(self, rows, keysOnly):
+        if keysOnly:
+            return [ndb.Key(urlsafe=row[0]) for row in rows]
+        return [self._repo._decode(row[1]) for row in rows]
+
+    def __iter__(self):
+        return self.iter()
+
+    def iter(self, batchSize=None):
+        for result, _ in self.iterWithCursors(batchSize=batchSize):
+            yield result
+
+    def fetch(self, limit=None, keysOnly=False, projection=None):
+        """Results; projections return whole entities."""
+        return self._results(self._select('e.key, e.pb', limit), keysOnly)
+
+    def fetchAsync(self, limit=None, keysOnly=False):
+        results = self.fetch(limit, keysOnly)
+        return Result(lambda: results)
+
+    def fetchPage(self, pageSize, cursor=None, keysOnly=False):
+        """(results, cursor for the next page or None when done)"""
+        offset = self._offset(cursor)
+        rows = self._select('e.key, e.pb', pageSize + 1, offset)
+        more = len(rows) > pageSize
+        return (self._results(rows[:pageSize], keysOnly),
+                str(offset + pageSize) if more else None)
+
+    def iterWithCursors(self, cursor=None, batchSize=None):
+        """Yield (result, cursor after result) from cursor on."""
+        offset = self._offset(cursor)
+        batchSize = batchSize or 100
+        while True:
+            rows = self._select('e.key, e.pb', batchSize, offset)
+            for result in self._results(rows, False):
+                offset += 1
+                yield result, str(offset)
+            if len(rows) < batchSize:
+                return
+
+    def count(self, limit=None):
+        where, params = self._where()
+        count = self._repo._run('SELECT COUNT(*) FROM entities e WHERE %s' % where,
+                                params)[0][0]
+        return min(count, limit) if limit is not None else count
+
+    def get(self):
+        results = self.fetch(1)
+        return results[0] if results else None
+
+    @staticmethod
+    def _offset(cursor):
+        if not cursor:
+            return 0
+        try:
+            offset = int(cursor)
+        except ValueError:
+            raise BadCursorError('Invalid cursor: %s' % cursor)
+        if offset < 0:
+            raise BadCursorError('Invalid cursor: %s' % cursor)
+        return offset
+
+
+def openRepository(storage):
+    """Repository for a CONFERENCE_STORAGE value: 'ndb', or 'sqlite' with
+    an optional ':<path>'.
+    """
+    backend, _, path = storage.partition(':')
+    if backend == 'ndb':
+        return NdbRepository()
+    if backend == 'sqlite':
+        return SqliteRepository(path or ':memory:')
+    raise ValueError('Unknown %s: %s' % (STORAGE_ENV, storage))
+
+
+# one repository per instance, shared by all request threads
+repo = openRepository(os.environ.get(STORAGE_ENV, 'ndb'))
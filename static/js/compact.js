@@ -0,0 +1,54 @@
+'use strict';
+
+/**
+ * The root conferenceApp module.
+ *
+ * @type {conferenceApp|*|{}}
+ */
+var conferenceApp = conferenceApp || {};
+
+/**
+ * @ngdoc function
+ * @name decodeCompact
+ *
+ * @description
+ * Decodes a columnar CompactForms response (queryConferencesCompact,
+ * getConferenceSessionsCompact) into an array with one object per item.
+ *
+ * @param {Object} compact the response result
+ * @returns {Array}
+ */
+conferenceApp.decodeCompact = function (compact) {
+    var count = compact.count || 0;
+    var items = [];
+    var i;
+    for (i = 0; i < count; i++) {
+        items.push({});
+    }
+    var columns = compact.columns || [];
+    for (var c = 0; c < columns.length; c++) {
+        var column = columns[c];
+        var values = column.strings || [];
+        if (!column.strings) {
+            var ints = column.ints || [];
+            var dictionary = column.dictionary;
+            values = [];
+            for (i = 0; i < ints.length; i++) {
+                values.push(dictionary ? dictionary[ints[i]] : ints[i]);
+            }
+        }
+        if (column.lengths) {
+            // list column: each item takes its length worth of values
+            var offset = 0;
+            for (i = 0; i < count; i++) {
+                items[i][column.name] = values.slice(offset, offset + column.lengths[i]);
+                offset += column.lengths[i];
+            }
+        } else {
+            for (i = 0; i < count; i++) {
+                items[i][column.name] = values[i];
+            }
+        }
+    }
+    return items;
+};
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""test_confirmation_emails.py
+
+Conference Central tests of the batched confirmation email cron, against
+the App Engine testbed's taskqueue & mail stubs
+
+usage: GAE_SDK=~/google-cloud-sdk/platform/google_appengine \\
+           python -m unittest discover -s tests
+
+"""
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import loadtest
+loadtest.fixSysPath(os.path.expanduser(os.environ['GAE_SDK']))
+
+import webob
+from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import testbed
+
+import main
+from conference import CONFIRMATION_EMAIL_QUEUE
+
+
+class SendConfirmationEmailsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=loadtest.ROOT)
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.mail = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        self.queue = taskqueue.Queue(CONFIRMATION_EMAIL_QUEUE)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def _enqueue(self, email, wsck):
+        self.queue.add(taskqueue.Task(method='PULL', payload=json.dumps({
+            'email': email,
+            'websafeConferenceKey': wsck,
+            'conferenceInfo': 'conference %s' % wsck})))
+
+    def _run(self):
+        response = webob.Request.blank('/crons/send_confirmation_emails').get_response(main.app)
+        self.assertEqual(response.status_int, 204)
+
+    def _sent(self):
+        return sorted((msg.to, msg.body.decode()) for msg in self.mail.get_sent_messages())
+
+    def testOneEmailPerRecipient(self):
+        self._enqueue('a@example.com', 'c1')
+        self._enqueue('a@example.com', 'c2')
+        self._enqueue('a@example.com', 'c1')
+        self._enqueue('b@example.com', 'c3')
+        self._run()
+
+        sent = self._sent()
+        self.assertEqual([to for to, _ in sent], ['a@example.com', 'b@example.com'])
+        self.assertEqual(sent[0][1].count('conference c1'), 1)
+        self.assertIn('conference c2', sent[0][1])
+        self.assertEqual(self.queue.fetch_statistics().tasks, 0)
+
+    def testFailedSendIsRetriedThenDropped(self):
+        send_mail = mail.send_mail
+        def failing(sender, to, subject, body):
+            if to == 'bad':
+                raise mail.InvalidEmailError()
+            return send_mail(sender, to, subject, body)
+        mail.send_mail = failing
+        self.addCleanup(setattr, mail, 'send_mail', send_mail)
+        lease_seconds = main.EMAIL_LEASE_SECONDS
+        main.EMAIL_LEASE_SECONDS = 0    # leased again by the next run
+        self.addCleanup(setattr, main, 'EMAIL_LEASE_SECONDS', lease_seconds)
+
+        self._enqueue('bad', 'c1')
+        self._enqueue('a@example.com', 'c2')
+        self._run()
+        self.assertEqual([to for to, _ in self._sent()], ['a@example.com'])
+        self.assertEqual(self.queue.fetch_statistics().tasks, 1)
+
+        for _ in range(main.EMAIL_MAX_LEASES - 1):
+            self._run()
+        self.assertEqual(self.queue.fetch_statistics().tasks, 0)
+        self.assertEqual([to for to, _ in self._sent()], ['a@example.com'])
+
+
+if __name__ == '__main__':
+    unittest.main()